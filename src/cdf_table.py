@@ -0,0 +1,119 @@
+import math
+import bisect
+
+import numpy as np
+from scipy.special import ndtr
+
+
+CDF_MODES = ('nearest', 'interpolate', 'exact')
+
+
+class CDF_Table:
+    def __init__(self, table: dict, mode: str = 'nearest') -> None:
+        '''
+        Lookup of p-values (upper tail probabilities of the normal distribution) for z-values,
+        based on a table mapping z-values to p-values. The table is converted to sorted arrays
+        once, so lookups work on whole arrays of z-values.
+
+        Args:
+            table (dict): A dictionary mapping z-values to p-values.
+            mode (str): 'nearest' for the p-value of the closest z-value in the table,
+                'interpolate' for linear interpolation between the table entries and 'exact'
+                to calculate the p-value with scipy.special.ndtr instead of using the table.
+
+        Returns:
+            None
+        '''
+        assert mode in CDF_MODES, f'Unknown mode {mode}'
+
+        self.mode = mode
+
+        keys = np.fromiter(table.keys(), dtype=np.float64, count=len(table))
+        values = np.fromiter(table.values(), dtype=np.float64, count=len(table))
+        order = np.argsort(keys)
+
+        self.z_values = keys[order]
+        self.p_values = values[order]
+
+        # Lists for scalar lookups, which are faster without NumPy overhead
+        self.z_list = self.z_values.tolist()
+        self.p_list = self.p_values.tolist()
+
+
+    def __call__(self, z_values):
+        '''
+        Returns the p-values for the given z-values.
+
+        Args:
+            z_values (float or np.ndarray): The z-value(s).
+
+        Returns:
+            float or np.ndarray: The p-value(s).
+        '''
+
+        if isinstance(z_values, float) or np.ndim(z_values) == 0:
+            return self.lookup_scalar(float(z_values))
+
+        if self.mode == 'exact':
+            return ndtr(-np.asarray(z_values, dtype=np.float64))
+        elif self.mode == 'interpolate':
+            return np.interp(z_values, self.z_values, self.p_values)
+        else:
+            return self.closest(z_values)
+
+
+    def lookup_scalar(self, z_value: float) -> float:
+        '''
+        Returns the p-value for a single z-value.
+
+        Args:
+            z_value (float): The z-value.
+
+        Returns:
+            float: The p-value.
+        '''
+
+        if self.mode == 'exact':
+            return 0.5 * math.erfc(z_value / math.sqrt(2))
+
+        index = bisect.bisect_left(self.z_list, z_value)
+
+        if index == 0:
+            return self.p_list[0]
+        elif index == len(self.z_list):
+            return self.p_list[-1]
+
+        lower_z, upper_z = self.z_list[index - 1], self.z_list[index]
+        lower_p, upper_p = self.p_list[index - 1], self.p_list[index]
+
+        if self.mode == 'interpolate':
+            return lower_p + (upper_p - lower_p) * (z_value - lower_z) / (upper_z - lower_z)
+        elif abs(z_value - lower_z) < abs(z_value - upper_z):
+            return lower_p
+        else:
+            return upper_p
+
+
+    def closest(self, z_values) -> np.ndarray:
+        '''
+        Returns the p-values of the closest z-values in the table. Outside of the table the
+        first or last p-value is used.
+
+        Args:
+            z_values (float or np.ndarray): The z-value(s).
+
+        Returns:
+            np.ndarray: The closest p-value(s).
+        '''
+
+        z_values = np.asarray(z_values, dtype=np.float64)
+        keys = self.z_values
+
+        upper = np.clip(np.searchsorted(keys, z_values, side='left'), 1, len(keys) - 1)
+        lower = upper - 1
+
+        closest = np.where(np.abs(z_values - keys[lower]) < np.abs(z_values - keys[upper]), lower, upper)
+        closest = np.where(z_values <= keys[0], 0, closest)
+        closest = np.where(z_values > keys[-1], len(keys) - 1, closest)
+
+        return self.p_values[closest]
@@ -1,7 +1,7 @@
 import io
-import sqlite3
 
 from density_map import get_density_image
+from refined_db import read_snapshot
 
 from flask import Flask, send_file, request
 import pandas as pd
@@ -42,6 +42,7 @@ def get_density_map(floor_id):
     plot_devices = request.args.get('plot_devices', default=False, type=bool)
     dpi = request.args.get('dpi', default=200, type=int)
     grid_size = request.args.get('grid_size', default=0.1, type=float)
+    timestamp = request.args.get('timestamp', default=None, type=int)
 
     color1 = request.args.get('color1', default='[100,0,0]')
     color2 = request.args.get('color2', default='[0,100,0]')
@@ -59,8 +60,8 @@ def get_density_map(floor_id):
 
     print(f'mpl_cmap: {mpl_cmap}, alpha: {alpha}, plot_devices: {plot_devices}, dpi: {dpi}, custom_colors: {custom_colors}, grid_size: {grid_size}')
 
-    # Loading most recent batch
-    batch = get_last_batch()
+    # Loading most recent batch, or the batch at the requested time
+    batch = get_last_batch(timestamp)
 
     # Getting the density map
     density_map_bytes = get_density_image(
@@ -81,29 +82,18 @@ def get_density_map(floor_id):
     )
 
 
-def get_last_batch() -> pd.DataFrame:
+def get_last_batch(timestamp: int = None) -> pd.DataFrame:
     '''
     Get the most recent batch of data.
+
+    Args:
+        timestamp (int): Get the latest batch at or before this timestamp instead.
     
     Returns:
         pd.DataFrame: Most recent batch of data.
     '''
 
-    conn = sqlite3.connect('../data/refined_data.db')
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT timestamp FROM data_refined ORDER BY id DESC LIMIT 1")
-    timestamp = cursor.fetchone()[0]
-
-    cursor.execute("SELECT * FROM data_refined WHERE timestamp = ?", (timestamp,))
-    rows = cursor.fetchall()
-    descritions = [description[0] for description in cursor.description]
-
-    conn.close()
-
-    batch = pd.DataFrame(rows, columns=descritions)
-    batch['floor_id'] = batch['floor_id'].astype(int)
-    batch['room_id'] = batch['room_id'].astype(str)
+    batch = read_snapshot(timestamp)
 
     return batch
 
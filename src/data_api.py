@@ -1,14 +1,24 @@
+import os
 import requests
 import json
 
 from dotenv import dotenv_values
+import numpy as np
 import pandas as pd
 
 
+COLUMNS = ['timestamp', 'type', 'mac', 'map_id', 'site_id', 'rssi', 'x', 'y']
+CATEGORICAL_COLUMNS = ['type', 'mac', 'map_id', 'site_id']
+
+PATH_WATERMARK = '../data/objects/ingest_watermark.json'
+WATERMARK_OVERLAP = 60 # Records up to a minute older than the watermark are queried again to catch late arrivals
+STREAM_CHUNK_SIZE = 1 << 16 # Bytes read at a time from a streamed response
+
+
 class Data_API:
-    def __init__(self) -> None:
+    def __init__(self, path_watermark: str = PATH_WATERMARK) -> None:
         config = dotenv_values("../.env")
-        
+
         self.headers = {
             "Authorization": f"Splunk {config['DATA_API_KEY']}",
         }
@@ -20,23 +30,47 @@ class Data_API:
             "earliest_time": "-10m@m",
         }
 
-    
-    def get_last_batch(self) -> pd.DataFrame:
+        self.path_watermark = path_watermark
+        self.watermark, self.seen_keys = self.load_watermark()
+
+
+    def get_last_batch(self, stream: bool = True, incremental: bool = True) -> pd.DataFrame:
         '''
         Get the most recent batch of data.
-        
+
+        Args:
+            stream (bool): If the response should be decoded incrementally while it is downloaded,
+                instead of first reading the whole response into memory.
+            incremental (bool): If only data newer than the watermark should be returned. The
+                watermark is advanced by commit_watermark once the batch has been processed.
+
         Returns:
             pd.Dataframe: Most recent batch of data.
         '''
 
+        data = self.data.copy()
+        if incremental and self.watermark is not None:
+            data['earliest_time'] = str(self.watermark - WATERMARK_OVERLAP)
+            data['latest_time'] = 'now'
+
         url = 'https://imperial-college.splunkcloud.com:8089/servicesNS/occupancy_api/imperial_college/search/v2/jobs/export'
-        response = requests.post(url, headers=self.headers, data=self.data)
+        response = requests.post(url, headers=self.headers, data=data, stream=stream)
 
-        assert response.status_code == 200, f'Error: {response.status_code}'
+        with response:
+            assert response.status_code == 200, f'Error: {response.status_code}'
 
-        data = self.parse_multiple_json(response.text)
-        data = [entry['result'] for entry in data]
-        data = pd.DataFrame(data)
+            if stream:
+                objects = iter_response_objects(response)
+            else:
+                objects = self.parse_multiple_json(response.text)
+
+            columns = new_column_buffers()
+            for entry in objects:
+                append_result(columns, entry)
+
+        data = columns_to_frame(columns)
+        if incremental:
+            data = self.drop_processed(data)
         print(data.head())
         # data = data.sort_values(by='timestamp', ascending=True)
         # data = data.reset_index(drop=True)
@@ -44,32 +78,253 @@ class Data_API:
         return data
 
 
+    def drop_processed(self, batch: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Drop the records of the batch that were already processed, based on the watermark and
+        the (mac, timestamp) keys seen close to it. Duplicates within the batch are dropped as well.
+
+        Args:
+            batch (pd.DataFrame): Batch data.
+
+        Returns:
+            pd.DataFrame: Batch data without processed records.
+        '''
+
+        batch = batch.drop_duplicates(subset=['mac', 'timestamp'])
+
+        if self.watermark is not None:
+            keys = pd.MultiIndex.from_arrays([batch['mac'].astype(str), batch['timestamp']])
+            new = batch['timestamp'].to_numpy() > self.watermark - WATERMARK_OVERLAP
+            new &= ~keys.isin(self.seen_keys)
+            batch = batch[new]
+
+        return batch.reset_index(drop=True)
+
+
+    def commit_watermark(self, batch: pd.DataFrame) -> None:
+        '''
+        Advance the watermark past a processed batch and save it.
+
+        Args:
+            batch (pd.DataFrame): Processed batch data.
+
+        Returns:
+            None
+        '''
+
+        if len(batch) == 0:
+            return
+
+        watermark = int(batch['timestamp'].max())
+        if self.watermark is not None:
+            watermark = max(watermark, self.watermark)
+
+        recent = batch[batch['timestamp'] > watermark - WATERMARK_OVERLAP]
+        seen_keys = {key for key in self.seen_keys if key[1] > watermark - WATERMARK_OVERLAP}
+        seen_keys.update(zip(recent['mac'].astype(str), recent['timestamp'].astype(int)))
+
+        self.watermark = watermark
+        self.seen_keys = seen_keys
+        self.save_watermark()
+
+
+    def load_watermark(self) -> tuple:
+        '''
+        Load the watermark and the keys seen close to it.
+
+        Returns:
+            tuple: Watermark (None if nothing was processed yet) and set of (mac, timestamp) keys.
+        '''
+
+        if not os.path.exists(self.path_watermark):
+            return None, set()
+
+        with open(self.path_watermark, 'r') as file:
+            state = json.load(file)
+
+        seen_keys = {(mac, timestamp) for mac, timestamp in state['seen_keys']}
+
+        return state['watermark'], seen_keys
+
+
+    def save_watermark(self) -> None:
+        '''
+        Save the watermark, replacing the previous file atomically.
+
+        Returns:
+            None
+        '''
+
+        state = {
+            'watermark': self.watermark,
+            'seen_keys': sorted(self.seen_keys),
+        }
+
+        path_tmp = f'{self.path_watermark}.tmp'
+        with open(path_tmp, 'w') as file:
+            json.dump(state, file)
+        os.replace(path_tmp, self.path_watermark)
+
+
     def parse_multiple_json(self, text):
         '''
         Convert a string with multiple JSON objects to a list of JSON objects.
-        
+
         Args:
             text (str): String with multiple JSON objects.
         '''
 
-        json_objects = []
-        buffer = ""
-        open_brackets = 0
-
-        for char in text:
-            buffer += char
-            if char == '{':
-                open_brackets += 1
-            elif char == '}':
-                open_brackets -= 1
-                if open_brackets == 0:
-                    try:
-                        json_objects.append(json.loads(buffer))
-                    except json.JSONDecodeError:
-                        print("Failed to decode JSON:", buffer)
-                    buffer = ""
-
-        return json_objects
+        return list(iter_json_objects([text]))
+
+
+def iter_json_objects(chunks):
+    '''
+    Incrementally decode a stream of concatenated JSON objects. Only the part of the stream
+    belonging to an object that is not yet complete is kept in memory.
+
+    Args:
+        chunks (iterable): Iterable of strings, e.g. the lines of a streamed response.
+
+    Yields:
+        dict: Decoded JSON object.
+    '''
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+
+        while True:
+            start = buffer.find('{', position)
+            if start == -1:
+                position = len(buffer)
+                break
+
+            try:
+                json_object, position = decoder.raw_decode(buffer, start)
+            except json.JSONDecodeError:
+                # Top level objects start on a new line, so if another one follows this one is broken
+                next_start = buffer.find('\n{', start)
+                if next_start == -1:
+                    position = start
+                    break
+
+                print("Failed to decode JSON:", buffer[start:next_start])
+                position = next_start + 1
+                continue
+
+            yield json_object
+
+        buffer = buffer[position:]
+
+    if buffer.strip():
+        print("Failed to decode JSON:", buffer)
+
+
+def iter_response_objects(response: requests.Response, chunk_size: int = STREAM_CHUNK_SIZE):
+    '''
+    Incrementally decode the JSON objects of a streamed response, see iter_json_objects.
+
+    Args:
+        response (requests.Response): Response, requested with stream=True.
+        chunk_size (int): Bytes read at a time.
+
+    Yields:
+        dict: Decoded JSON object.
+    '''
+
+    # iter_lines strips the newlines, which are needed to find the start of the next object
+    response.encoding = response.encoding or 'utf-8'
+    lines = (line + '\n' for line in response.iter_lines(chunk_size=chunk_size, decode_unicode=True))
+
+    yield from iter_json_objects(lines)
+
+
+def new_column_buffers() -> dict:
+    '''
+    Create empty column buffers for a batch.
+
+    Returns:
+        dict: Mapping of column names to empty lists.
+    '''
+
+    return {column: [] for column in COLUMNS}
+
+
+def parse_numeric(values: list) -> np.ndarray:
+    '''
+    Parse a numeric column buffer as float64, with NaN for missing or malformed values such as ''.
+
+    Args:
+        values (list): Column buffer.
+
+    Returns:
+        np.ndarray: Parsed values.
+    '''
+
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+
+
+def columns_to_frame(columns: dict) -> pd.DataFrame:
+    '''
+    Convert the column buffers to a typed batch. The numeric columns are parsed in bulk and the
+    repeated identifiers are dictionary-encoded as categoricals. Rows with a missing or malformed
+    timestamp, rssi or position, or an rssi outside of the int16 range, are dropped, as they
+    cannot be cast.
+
+    Args:
+        columns (dict): Column buffers.
+
+    Returns:
+        pd.DataFrame: Batch with int64 timestamps, int16 rssi, float64 coordinates and
+            categorical type, mac, map_id and site_id.
+    '''
+
+    # Parsed as float first as the export may contain timestamps like '1726000000.0'
+    timestamps = parse_numeric(columns['timestamp'])
+    rssi_values = parse_numeric(columns['rssi'])
+    xs = parse_numeric(columns['x'])
+    ys = parse_numeric(columns['y'])
+
+    valid = np.isfinite(timestamps) & np.isfinite(xs) & np.isfinite(ys)
+    valid &= (rssi_values >= np.iinfo(np.int16).min) & (rssi_values <= np.iinfo(np.int16).max)
+    if not valid.all():
+        print(f'Dropped {np.count_nonzero(~valid)} rows with a missing or invalid timestamp, rssi or position')
+
+    data = {
+        'timestamp': timestamps[valid].astype(np.int64),
+        'rssi': rssi_values[valid].astype(np.int16),
+        'x': xs[valid],
+        'y': ys[valid],
+    }
+
+    for column in CATEGORICAL_COLUMNS:
+        data[column] = pd.Categorical(np.asarray(columns[column], dtype=object)[valid])
+
+    return pd.DataFrame(data, columns=COLUMNS)
+
+
+def append_result(columns: dict, entry: dict) -> None:
+    '''
+    Append the result of a Splunk export object to the column buffers. Objects without
+    a result (e.g. messages) are ignored.
+
+    Args:
+        columns (dict): Column buffers.
+        entry (dict): Decoded Splunk export object.
+
+    Returns:
+        None
+    '''
+
+    result = entry.get('result')
+    if result is None:
+        return
+
+    for column in COLUMNS:
+        columns[column].append(result.get(column))
 
 
 
@@ -1,10 +1,9 @@
-import json
-import pickle
 from io import BytesIO
 
+from floor_geometries import load_floor
+
 import numpy as np
 import pandas as pd
-from shapely.geometry import Polygon, Point
 from shapely.vectorized import contains, touches
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -39,7 +38,7 @@ def get_density_image(
     '''
 
     batch = batch[batch['floor_id'] == floor_id]
-    batch = batch[batch['room_id'] != 'None']
+    batch = batch[batch['room_id'].notna()]
     batch = batch.reset_index(drop=True)
 
     rooms = get_rooms(floor_id)
@@ -79,14 +78,8 @@ def get_rooms(floor_id: int) -> list:
         list: A list of shapely Polygon objects.
     '''
 
-    with open('../data/id_mappings/floorId_to_roomIds.json', 'r') as file:
-        floorId_to_roomIds = json.load(file)
-
-    with open('../data/objects/room_geometries.pkl', 'rb') as file:
-        room_geometries = pickle.load(file)
-
-    room_ids = floorId_to_roomIds[str(floor_id)]
-    rooms = [room_geometries[room_id] for room_id in room_ids]
+    # Only the file of the floor is read, the one of the current index
+    room_ids, rooms = load_floor(floor_id)
 
     return rooms
 
@@ -1,38 +1,527 @@
-import bisect
+from cdf_table import CDF_Table
+
+import sqlite3
 
 import numpy as np
-import scipy.stats as stats
 
 
 WIFI_ERROR = 10
 
+WINDOW = 12 # Maximum number of most recent data points used for a position estimate, trades accuracy for CPU time
+HISTORY_SIZE = 16 # Data points kept per device, at least WINDOW
+INITIAL_CAPACITY = 1024
+
+# Ring buffers of the DeviceStore with one row per device, and values with one entry per device
+HISTORY_FIELDS = {
+    'xs': np.float64,
+    'ys': np.float64,
+    'rssi_values': np.float64,
+    'weights': np.float64,
+    'timestamps': np.int64,
+    'floor_ids': np.int64,
+}
+SLOT_FIELDS = {
+    'heads': np.int64, # Column the next data point is written to
+    'counts': np.int64, # Number of data points added since the device was added
+    'changed': np.bool_, # If the device changed since the last checkpoint
+}
+
+CHECKPOINT_MMAP_SIZE = 256 * 1024**2 # Checkpoints are read through a memory map of up to this size
+
+# History fields saved in checkpoints with their stored type, the weights are recalculated from the RSSI values
+CHECKPOINT_FIELDS = {
+    'xs': np.float64,
+    'ys': np.float64,
+    'rssi_values': np.float64,
+    'timestamps': np.int64,
+    'floor_ids': np.int32,
+}
+
+
+def rssi_weight(rssi):
+    '''
+    Weight of a data point based on its RSSI value, works on scalars and arrays.
+
+    Args:
+        rssi (float or np.ndarray): RSSI value(s).
+
+    Returns:
+        float or np.ndarray: Weight(s) between 0 and 1.
+    '''
+
+    return (1/2) * np.tanh(0.1*rssi + 8) + 0.5 # rssi < -80: approx 0, rssi = -70: 0.5, rssi > -60: approx 1
+
+
+class DeviceStore:
+    def __init__(self, history_size: int = HISTORY_SIZE, capacity: int = INITIAL_CAPACITY) -> None:
+        '''
+        Stores the recent data of all devices as arrays, with a fixed size ring buffer per device.
+        Each device occupies one row (slot) of the arrays, slots of removed devices are reused.
+
+        Args:
+            history_size (int): Number of most recent data points kept per device.
+            capacity (int): Initial number of slots, grows when needed.
+
+        Returns:
+            None
+        '''
+
+        self.history_size = history_size
+        self.capacity = 0
+
+        self.slots = {} # mac -> slot
+        self.macs = []
+        self.free_slots = []
+
+        self.removed_macs = [] # Devices removed since the last checkpoint
+        self.checkpoint_path = None # Checkpoint the changes are relative to
+
+        for field, dtype in HISTORY_FIELDS.items():
+            setattr(self, field, np.empty((0, history_size), dtype=dtype))
+        for field, dtype in SLOT_FIELDS.items():
+            setattr(self, field, np.empty(0, dtype=dtype))
+        self.estimates = np.empty((0, 3), dtype=np.float64) # x, y and error of the estimated position
+
+        self.grow(capacity)
+
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+
+    def __contains__(self, mac: str) -> bool:
+        return mac in self.slots
+
+
+    def __getitem__(self, mac: str) -> 'Device':
+        return Device.view(self, self.slots[mac])
+
+
+    def __iter__(self):
+        return iter(self.slots)
+
+
+    def devices(self):
+        '''
+        Iterate over all devices in the store.
+
+        Yields:
+            Device: Device view.
+        '''
+
+        for slot in self.slots.values():
+            yield Device.view(self, slot)
+
+
+    def copy(self) -> 'DeviceStore':
+        '''
+        Copy the store, e.g. to restore it when a batch fails halfway.
+
+        Returns:
+            DeviceStore: Independent copy.
+        '''
+
+        store = DeviceStore.__new__(DeviceStore)
+        store.__dict__ = {key: value.copy() if isinstance(value, (np.ndarray, list, dict)) else value for key, value in self.__dict__.items()}
+
+        return store
+
+
+    def grow(self, capacity: int) -> None:
+        '''
+        Grow the arrays to the given number of slots.
+
+        Args:
+            capacity (int): New number of slots.
+
+        Returns:
+            None
+        '''
+
+        for field in HISTORY_FIELDS:
+            array = getattr(self, field)
+            grown = np.zeros((capacity, self.history_size), dtype=array.dtype)
+            grown[:self.capacity] = array
+            setattr(self, field, grown)
+
+        for field in SLOT_FIELDS:
+            array = getattr(self, field)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.capacity] = array
+            setattr(self, field, grown)
+
+        estimates = np.full((capacity, 3), np.nan)
+        estimates[:self.capacity] = self.estimates
+        self.estimates = estimates
+
+        self.macs.extend([None] * (capacity - self.capacity))
+        self.free_slots.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+
+    def add_device(self, mac: str) -> int:
+        '''
+        Assign a slot to a new device.
+
+        Args:
+            mac (str): The MAC address of the device.
+
+        Returns:
+            int: Slot of the device.
+        '''
+
+        assert mac not in self.slots, f'Device {mac} already exists'
+
+        if len(self.free_slots) == 0:
+            self.grow(2 * self.capacity)
+
+        slot = self.free_slots.pop()
+        self.slots[mac] = slot
+        self.macs[slot] = mac
+
+        self.heads[slot] = 0
+        self.counts[slot] = 0
+        self.changed[slot] = True
+        self.estimates[slot] = np.nan
+
+        return slot
+
+
+    def append(self, slots: np.ndarray, xs: np.ndarray, ys: np.ndarray, rssi_values: np.ndarray, timestamps: np.ndarray, floor_ids: np.ndarray, weights: np.ndarray) -> None:
+        '''
+        Append data points of any number of devices to their ring buffers. The data points of
+        each device are appended in the given order.
+
+        Args:
+            slots (np.ndarray): Slot of the device of each data point.
+            xs (np.ndarray): x-coordinates.
+            ys (np.ndarray): y-coordinates.
+            rssi_values (np.ndarray): RSSI values.
+            timestamps (np.ndarray): Timestamps.
+            floor_ids (np.ndarray): Floor IDs.
+            weights (np.ndarray): Weights, see rssi_weight.
+
+        Returns:
+            None
+        '''
+
+        order = np.argsort(slots, kind='stable')
+        slots = slots[order]
+
+        starts = np.flatnonzero(np.diff(slots, prepend=-1))
+        sizes = np.diff(np.append(starts, len(slots)))
+        ranks = np.arange(len(slots)) - np.repeat(starts, sizes)
+
+        # Data points that would be overwritten within this call are skipped
+        keep = ranks >= np.repeat(sizes, sizes) - self.history_size
+        rows = slots[keep]
+        columns = (self.heads[rows] + ranks[keep]) % self.history_size
+        selection = order[keep]
+
+        self.xs[rows, columns] = xs[selection]
+        self.ys[rows, columns] = ys[selection]
+        self.rssi_values[rows, columns] = rssi_values[selection]
+        self.timestamps[rows, columns] = timestamps[selection]
+        self.floor_ids[rows, columns] = floor_ids[selection]
+        self.weights[rows, columns] = weights[selection]
+
+        device_slots = slots[starts]
+        self.heads[device_slots] = (self.heads[device_slots] + sizes) % self.history_size
+        self.counts[device_slots] += sizes
+        self.changed[device_slots] = True
+
+
+    def history(self, slot: int, field: str) -> np.ndarray:
+        '''
+        Get the stored history of a device, oldest data point first.
+
+        Args:
+            slot (int): Slot of the device.
+            field (str): Name of the history field, e.g. 'timestamps'.
+
+        Returns:
+            np.ndarray: History of the field.
+        '''
+
+        length = min(self.counts[slot], self.history_size)
+        columns = (self.heads[slot] - length + np.arange(length)) % self.history_size
+
+        return getattr(self, field)[slot, columns]
+
+
+    def last(self, field: str) -> np.ndarray:
+        '''
+        Get the most recent value of a field for all slots.
+
+        Args:
+            field (str): Name of the history field, e.g. 'timestamps'.
+
+        Returns:
+            np.ndarray: Most recent value per slot, undefined for empty slots.
+        '''
+
+        columns = (self.heads - 1) % self.history_size
+
+        return getattr(self, field)[np.arange(self.capacity), columns]
+
+
+    def prune(self, min_timestamp: int) -> None:
+        '''
+        Remove the devices whose most recent data point is not newer than the given timestamp.
+
+        Args:
+            min_timestamp (int): Timestamp.
+
+        Returns:
+            None
+        '''
+
+        expired = (self.counts > 0) & (self.last('timestamps') <= min_timestamp)
+
+        for slot in np.flatnonzero(expired).tolist():
+            del self.slots[self.macs[slot]]
+            self.removed_macs.append(self.macs[slot])
+            self.macs[slot] = None
+            self.counts[slot] = 0
+            self.changed[slot] = False
+            self.free_slots.append(slot)
+
+
+    def save(self, path: str) -> None:
+        '''
+        Checkpoint the store to an SQLite file with one row per device and one column per field.
+        Only the devices that changed since the last checkpoint to the same file are written and
+        removed devices are deleted, otherwise the file is rewritten.
+
+        Args:
+            path (str): Path of the checkpoint.
+
+        Returns:
+            None
+        '''
+
+        conn = connect_checkpoint(path)
+
+        with conn:
+            if self.checkpoint_path != path:
+                conn.execute('DELETE FROM devices')
+                conn.execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)', ('history_size', self.history_size))
+                slots = np.array(list(self.slots.values()), dtype=np.int64)
+            else:
+                conn.executemany('DELETE FROM devices WHERE mac = ?', [(mac,) for mac in self.removed_macs])
+                slots = np.flatnonzero(self.changed)
+
+            last_timestamps = self.last('timestamps')[slots]
+            fields = [getattr(self, field)[slots].astype(dtype) for field, dtype in CHECKPOINT_FIELDS.items()]
+
+            rows = []
+            for i, slot in enumerate(slots.tolist()):
+                row = [self.macs[slot], int(self.heads[slot]), int(self.counts[slot]), int(last_timestamps[i])]
+                row.extend(field[i].tobytes() for field in fields)
+                rows.append(row)
+
+            columns = ', '.join(CHECKPOINT_FIELDS)
+            placeholders = ', '.join('?' * (4 + len(CHECKPOINT_FIELDS)))
+            conn.executemany(f'INSERT OR REPLACE INTO devices (mac, head, count, last_timestamp, {columns}) VALUES ({placeholders})', rows)
+
+        conn.close()
+
+        self.changed[:] = False
+        self.removed_macs = []
+        self.checkpoint_path = path
+
+
+    @classmethod
+    def load(cls, path: str, history_size: int = HISTORY_SIZE) -> 'DeviceStore':
+        '''
+        Load a store from a checkpoint, see save. If the checkpoint was saved with another history
+        size, the ring buffers are resized, keeping the most recent data points.
+
+        Args:
+            path (str): Path of the checkpoint.
+            history_size (int): Number of most recent data points kept per device.
+
+        Returns:
+            DeviceStore: Loaded store.
+        '''
+
+        conn = connect_checkpoint(path)
+
+        saved_history_size = conn.execute("SELECT value FROM metadata WHERE key = 'history_size'").fetchone()
+        saved_history_size = history_size if saved_history_size is None else int(saved_history_size[0])
+
+        columns = ', '.join(CHECKPOINT_FIELDS)
+        rows = conn.execute(f'SELECT mac, head, count, {columns} FROM devices').fetchall()
+        conn.close()
+
+        num_devices = len(rows)
+        store = cls(history_size=history_size, capacity=max(INITIAL_CAPACITY, 2 * num_devices))
+
+        if num_devices > 0:
+            macs, heads, counts, *blobs = zip(*rows)
+            heads = np.array(heads, dtype=np.int64)
+            counts = np.array(counts, dtype=np.int64)
+
+            if saved_history_size == history_size:
+                columns = np.arange(history_size)
+            else:
+                # The kept data points are moved to the first columns, oldest first
+                lengths = np.minimum(np.minimum(counts, saved_history_size), history_size)
+                columns = (heads[:, None] - lengths[:, None] + np.arange(history_size)) % saved_history_size
+                heads = lengths % history_size
+                counts = np.where(lengths < history_size, lengths, counts)
+
+            for (field, dtype), blob in zip(CHECKPOINT_FIELDS.items(), blobs):
+                values = np.frombuffer(b''.join(blob), dtype=dtype).reshape(num_devices, saved_history_size)
+                getattr(store, field)[:num_devices] = np.take_along_axis(values, np.broadcast_to(columns, (num_devices, history_size)), axis=1)
+
+            store.weights[:num_devices] = rssi_weight(store.rssi_values[:num_devices])
+            store.heads[:num_devices] = heads
+            store.counts[:num_devices] = counts
+
+            store.macs[:num_devices] = macs
+            store.slots = dict(zip(macs, range(num_devices)))
+            store.free_slots = list(range(store.capacity - 1, num_devices - 1, -1))
+
+        # After resizing, the next checkpoint rewrites all devices with the new history size
+        if saved_history_size == history_size:
+            store.checkpoint_path = path
+        else:
+            print(f'Resized the history of the recent devices from {saved_history_size} to {history_size} data points')
+
+        return store
+
+
+def connect_checkpoint(path: str) -> sqlite3.Connection:
+    '''
+    Open a DeviceStore checkpoint, creating the tables if needed.
+
+    Args:
+        path (str): Path of the checkpoint.
+
+    Returns:
+        sqlite3.Connection: Connection to the checkpoint.
+    '''
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA mmap_size = {CHECKPOINT_MMAP_SIZE}')
+
+    columns = ', '.join(f'{field} BLOB' for field in CHECKPOINT_FIELDS)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS devices (mac TEXT PRIMARY KEY, head INTEGER, count INTEGER, last_timestamp INTEGER, {columns})')
+    conn.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value)')
+
+    return conn
+
 
 class Device:
-    def __init__(self, mac: str) -> None:
+    __slots__ = ('store', 'slot')
+
+    def __init__(self, mac: str, store: DeviceStore = None) -> None:
         '''
-        Initializes the device object.
+        Initializes the device object, a view on the data of the device in a DeviceStore.
         
         Args:
             mac (str): The MAC address of the device.
+            store (DeviceStore): Store to add the device to, a store of its own if None.
             
         Returns:
             None
         '''
 
-        self.mac = mac
+        if store is None:
+            store = DeviceStore(capacity=1)
+
+        self.store = store
+        self.slot = store.add_device(mac)
 
-        self.positions = []
-        self.rssi_values = []
-        self.timestamps = []
 
-        self.weights = []
+    @classmethod
+    def view(cls, store: DeviceStore, slot: int) -> 'Device':
+        '''
+        Device object for a device that already exists in the store.
 
-        self.x = None
-        self.y = None
-        self.error = None
+        Args:
+            store (DeviceStore): Store of the device.
+            slot (int): Slot of the device.
 
-        self.room_id = None
-        self.floor_ids = []
+        Returns:
+            Device: Device object.
+        '''
+
+        device = cls.__new__(cls)
+        device.store = store
+        device.slot = slot
+
+        return device
+
+
+    @property
+    def mac(self) -> str:
+        return self.store.macs[self.slot]
+
+    @property
+    def positions(self) -> np.ndarray:
+        return np.column_stack((self.store.history(self.slot, 'xs'), self.store.history(self.slot, 'ys')))
+
+    @property
+    def rssi_values(self) -> np.ndarray:
+        return self.store.history(self.slot, 'rssi_values')
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.store.history(self.slot, 'timestamps')
+
+    @property
+    def weights(self) -> np.ndarray:
+        return self.store.history(self.slot, 'weights')
+
+    @property
+    def floor_ids(self) -> np.ndarray:
+        return self.store.history(self.slot, 'floor_ids')
+
+    @property
+    def x(self) -> float:
+        return self.get_estimate(0)
+
+    @x.setter
+    def x(self, value: float) -> None:
+        self.store.estimates[self.slot, 0] = value
+
+    @property
+    def y(self) -> float:
+        return self.get_estimate(1)
+
+    @y.setter
+    def y(self, value: float) -> None:
+        self.store.estimates[self.slot, 1] = value
+
+    @property
+    def error(self) -> float:
+        return self.get_estimate(2)
+
+    @error.setter
+    def error(self, value: float) -> None:
+        self.store.estimates[self.slot, 2] = value
+
+
+    def get_estimate(self, index: int) -> float:
+        '''
+        Get a value of the position estimate, None if the position was not calculated yet.
+
+        Args:
+            index (int): 0 for x, 1 for y and 2 for the error.
+
+        Returns:
+            float: Value of the estimate.
+        '''
+
+        value = self.store.estimates[self.slot, index]
+        if np.isnan(value):
+            return None
+
+        return float(value)
 
 
     def add_data(self, x: float, y: float, rssi: float, timestamp: int, floor_id: int) -> None:
@@ -51,63 +540,94 @@ class Device:
         '''
         assert type(x) == float and type(y) == float and type(rssi) == float and type(timestamp) == int and type(floor_id) == int, 'Invalid data types'
 
-        self.positions.append([x, y])
-        self.rssi_values.append(rssi)
-        self.timestamps.append(timestamp)
-        self.floor_ids.append(floor_id)
+        self.add_data_bulk(
+            np.array([x]),
+            np.array([y]),
+            np.array([rssi]),
+            np.array([timestamp]),
+            np.array([floor_id]),
+            np.array([rssi_weight(rssi)])
+        )
+
 
-        self.weights.append((1/2) * np.tanh(0.1*rssi + 8) + 0.5) # rssi < -80: approx 0, rssi = -70: 0.5, rssi > -60: approx 1
+    def add_data_bulk(self, xs: np.ndarray, ys: np.ndarray, rssi_values: np.ndarray, timestamps: np.ndarray, floor_ids: np.ndarray, weights: np.ndarray) -> None:
+        '''
+        Add multiple data points to the device object at once.
+
+        Args:
+            xs (np.ndarray): x-coordinates of the device.
+            ys (np.ndarray): y-coordinates of the device.
+            rssi_values (np.ndarray): RSSI values of the device.
+            timestamps (np.ndarray): Timestamps of the data.
+            floor_ids (np.ndarray): Floor IDs of the data.
+            weights (np.ndarray): Weights of the data, see rssi_weight.
+
+        Returns:
+            None
+        '''
+
+        slots = np.full(len(xs), self.slot)
+        self.store.append(slots, xs, ys, rssi_values, timestamps, floor_ids, weights)
     
 
-    def update_position(self, zValue_to_pValue: dict) -> None:
+    def update_position(self, zValue_to_pValue: CDF_Table, window: int = WINDOW) -> None:
         '''
         Calculates the optimized position of the device based on averages of past positions and probability of movement.
+        The weighted means and variances are updated with running sums, so each data point costs O(1).
         
         Args:
-            zValue_to_pValue (dict): A dictionary mapping z-values (normalized distance) to p-values (probabilities).
+            zValue_to_pValue (CDF_Table): Lookup of p-values (probabilities) for z-values (normalized distances).
+            window (int): Maximum number of most recent data points used for the estimate, at most
+                the history size of the store.
             
         Returns:
             None
         '''
 
-        positions = np.array(self.positions)
-        positions = positions[::-1]
-        weights = np.array(self.weights)
-        weights = weights[::-1]
+        if window > self.store.history_size:
+            raise ValueError(f'Window of {window} data points is larger than the history of {self.store.history_size}')
 
-        if len(positions) == 1:
-            self.x = positions[0][0]
-            self.y = positions[0][1]
-            self.error = WIFI_ERROR
-            return
+        xs = self.store.history(self.slot, 'xs')[::-1][:window]
+        ys = self.store.history(self.slot, 'ys')[::-1][:window]
+        weights = self.weights[::-1][:window]
 
-        prev_x = positions[0][0]
-        prev_y = positions[0][1]
+        prev_x = xs[0]
+        prev_y = ys[0]
         prev_error = WIFI_ERROR
 
-        for i, position in enumerate(positions[1:]):
+        sum_w = weights[0]
+        sum_wx, sum_wy = weights[0] * xs[0], weights[0] * ys[0]
+        sum_wxx, sum_wyy = weights[0] * xs[0]**2, weights[0] * ys[0]**2
+
+        for i in range(1, len(xs)):
 
-            curr_x = position[0]
-            curr_y = position[1]
+            curr_x = xs[i]
+            curr_y = ys[i]
             radius_to_prev = np.sqrt((curr_x - prev_x)**2 + (curr_y - prev_y)**2)
 
             z = radius_to_prev / prev_error
-            probability_moved = 1 - 2 * self.closest_cdf(z, zValue_to_pValue)
-            probability_moved = probability_moved * weights[i]
+            probability_moved = 1 - 2 * zValue_to_pValue(z)
+            probability_moved = probability_moved * weights[i - 1]
 
             if probability_moved > 0.8:
                 break
 
-            upper_limit = i + 2
-            x_estimate = np.sum(weights[:upper_limit] * positions[:upper_limit, 0]) / np.sum(weights[:upper_limit])
-            y_estimate = np.sum(weights[:upper_limit] * positions[:upper_limit, 1]) / np.sum(weights[:upper_limit])
+            sum_w += weights[i]
+            sum_wx += weights[i] * curr_x
+            sum_wy += weights[i] * curr_y
+            sum_wxx += weights[i] * curr_x**2
+            sum_wyy += weights[i] * curr_y**2
+
+            x_estimate = sum_wx / sum_w
+            y_estimate = sum_wy / sum_w
 
-            if i == 0:
+            if i == 1:
                 error_estimate = WIFI_ERROR
             else:
-                error_x = np.sqrt(np.sum(weights[:upper_limit] * (positions[:upper_limit, 0] - x_estimate)**2) / np.sum(weights[:upper_limit]))
-                error_y = np.sqrt(np.sum(weights[:upper_limit] * (positions[:upper_limit, 1] - y_estimate)**2) / np.sum(weights[:upper_limit]))
-                error_estimate = np.sqrt(error_x**2 + error_y**2)
+                # Clipped at 0 as rounding can make the variance of (almost) equal positions negative
+                variance_x = max(sum_wxx / sum_w - x_estimate**2, 0)
+                variance_y = max(sum_wyy / sum_w - y_estimate**2, 0)
+                error_estimate = np.sqrt(variance_x + variance_y)
 
             prev_x = x_estimate
             prev_y = y_estimate
@@ -116,10 +636,6 @@ class Device:
             else:
                 prev_error = error_estimate
 
-            # Break to only include the most recent 10 data points
-            if i == 10:
-                break
-
         self.x = prev_x
         self.y = prev_y
         self.error = prev_error
@@ -147,32 +663,3 @@ class Device:
             return False
 
         return True
-
-
-    def closest_cdf(self, z_value: float, table: dict) -> float:
-        '''
-        Returns the closest p-value to the given z-value from the given table. Replaces explicit calculations of the CDF.
-        
-        Args:
-            z_value (float): The z-value.
-            table (dict): A dictionary mapping z-values to p-values.
-            
-        Returns:
-            float: The closest p-value to the given z-value.
-        '''
-
-        z_values = list(table.keys())
-        closest_index = bisect.bisect_left(z_values, z_value)
-        
-        if closest_index == 0:
-            return table[z_values[0]]
-        elif closest_index == len(z_values):
-            return table[z_values[-1]]
-        else:
-            lower_value = z_values[closest_index - 1]
-            upper_value = z_values[closest_index]
-            
-            if abs(z_value - lower_value) < abs(z_value - upper_value):
-                return table[lower_value]
-            else:
-                return table[upper_value]
\ No newline at end of file
@@ -0,0 +1,92 @@
+from device import DeviceStore, WIFI_ERROR, WINDOW
+from cdf_table import CDF_Table
+
+import numpy as np
+
+
+MOVED_PROBABILITY = 0.8 # Data points before a probable movement are not used for the estimate
+
+
+def update_positions(store: DeviceStore, slots: np.ndarray, zValue_to_pValue: CDF_Table, window: int = WINDOW) -> None:
+    '''
+    Calculates the optimized positions of many devices at once, with the same algorithm as
+    Device.update_position. The most recent data points of the devices are gathered into
+    (devices x window) matrices and the estimates are written to the store.
+
+    Args:
+        store (DeviceStore): Store of the devices.
+        slots (np.ndarray): Slots of the devices to update.
+        zValue_to_pValue (CDF_Table): Lookup of p-values (probabilities) for z-values (normalized distances).
+        window (int): Maximum number of data points used per device, at most the history size of
+            the store.
+
+    Returns:
+        None
+    '''
+
+    if window > store.history_size:
+        raise ValueError(f'Window of {window} data points is larger than the history of {store.history_size}')
+
+    slots = np.asarray(slots, dtype=np.int64)
+    if len(slots) == 0:
+        return
+
+    # Most recent data point first, padded with zero weights
+    lengths = np.minimum(np.minimum(store.counts[slots], store.history_size), window)
+    columns = (store.heads[slots, None] - 1 - np.arange(window)) % store.history_size
+    valid = np.arange(window) < lengths[:, None]
+
+    xs = store.xs[slots[:, None], columns]
+    ys = store.ys[slots[:, None], columns]
+    weights = np.where(valid, store.weights[slots[:, None], columns], 0.0)
+
+    means_x, means_y, errors = prefix_estimates(xs, ys, weights)
+
+    # The estimate before step i uses the i+1 most recent data points
+    distances = np.sqrt((xs[:, 1:] - means_x[:, :-1])**2 + (ys[:, 1:] - means_y[:, :-1])**2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z_values = distances / errors[:, :-1]
+    probability_moved = (1 - 2 * zValue_to_pValue(z_values)) * weights[:, :-1]
+
+    # Stop at the first step where the device probably moved, otherwise use all data points
+    moved = (probability_moved > MOVED_PROBABILITY) & valid[:, 1:]
+    used = lengths
+    if window > 1:
+        used = np.where(moved.any(axis=1), moved.argmax(axis=1) + 1, lengths)
+
+    rows = np.arange(len(slots))
+    store.estimates[slots, 0] = means_x[rows, used - 1]
+    store.estimates[slots, 1] = means_y[rows, used - 1]
+    store.estimates[slots, 2] = errors[rows, used - 1]
+
+
+def prefix_estimates(xs: np.ndarray, ys: np.ndarray, weights: np.ndarray) -> tuple:
+    '''
+    Weighted means and errors of all prefixes of the data points, from running sums of the
+    weighted moments.
+
+    Args:
+        xs (np.ndarray): x-coordinates, most recent first, one row per device.
+        ys (np.ndarray): y-coordinates, most recent first, one row per device.
+        weights (np.ndarray): Weights, most recent first, one row per device.
+
+    Returns:
+        tuple: Means of x and y and errors, column k using the k+1 most recent data points.
+    '''
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sum_weights = np.cumsum(weights, axis=1)
+        means_x = np.cumsum(weights * xs, axis=1) / sum_weights
+        means_y = np.cumsum(weights * ys, axis=1) / sum_weights
+        variance_x = np.cumsum(weights * xs**2, axis=1) / sum_weights - means_x**2
+        variance_y = np.cumsum(weights * ys**2, axis=1) / sum_weights - means_y**2
+
+    errors = np.sqrt(np.maximum(variance_x, 0) + np.maximum(variance_y, 0))
+    errors[np.isnan(errors) | (errors > WIFI_ERROR)] = WIFI_ERROR
+
+    # A single data point is its own estimate, and the error is only estimated from 3 data points on
+    means_x[:, 0] = xs[:, 0]
+    means_y[:, 0] = ys[:, 0]
+    errors[:, :2] = WIFI_ERROR
+
+    return means_x, means_y, errors
@@ -0,0 +1,288 @@
+import os
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+
+PATH_FLOORS_DIR = '../data/objects/floors'
+
+GEOMETRY_VERSION = 2 # Part of the floor hashes, so a change of the floor files rebuilds every floor
+MAX_CACHED_FLOORS = 64 # Floor trees kept in memory, the least recently used are dropped above it
+
+# Arrays of a floor, packed like shapely.to_ragged_array, each in its own .npy file so it can be memory-mapped
+FLOOR_ARRAYS = ('room_ids', 'coords', 'ring_offsets', 'polygon_offsets')
+
+
+def floor_hash(data_workspace: list, offset: list) -> str:
+    '''
+    Hash the inputs of the geometries of a floor, i.e. its workspace data and building offset.
+
+    Args:
+        data_workspace (list): Workspace data of the floor.
+        offset (list): Offset of the floor.
+
+    Returns:
+        str: Hex digest.
+    '''
+
+    payload = json.dumps({'version': GEOMETRY_VERSION, 'workspace': data_workspace, 'offset': offset}, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def index_path(directory: str = PATH_FLOORS_DIR) -> str:
+    '''
+    Path of the index of the floor files.
+
+    Args:
+        directory (str): Directory of the floor files.
+
+    Returns:
+        str: Path of index.json.
+    '''
+
+    return os.path.join(directory, 'index.json')
+
+
+def read_index(directory: str = PATH_FLOORS_DIR) -> dict:
+    '''
+    Read the index of the floor files.
+
+    Args:
+        directory (str): Directory of the floor files.
+
+    Returns:
+        dict: Hash and name of the floor files by floor ID (str), empty if there is no index yet.
+    '''
+
+    if not os.path.exists(index_path(directory)):
+        return {}
+
+    with open(index_path(directory), 'r') as file:
+        return json.load(file)
+
+
+def write_floor(floor_id: int, hash: str, room_geometries: dict, directory: str = PATH_FLOORS_DIR) -> str:
+    '''
+    Write the room geometries of a floor as packed coordinate and offset arrays, in a new
+    directory named after its hash. The floor is not used before it is added to the index.
+
+    Args:
+        floor_id (int): Floor ID.
+        hash (str): Hash of the floor, see floor_hash.
+        room_geometries (dict): Room geometries by room ID, in the order of the floor tree.
+        directory (str): Directory of the floor files.
+
+    Returns:
+        str: Name of the floor files, relative to the directory.
+    '''
+
+    name = f'{floor_id}-{hash[:16]}'
+    path = os.path.join(directory, name)
+
+    if len(room_geometries) > 0:
+        geometry_type, coords, (ring_offsets, polygon_offsets) = shapely.to_ragged_array(list(room_geometries.values()))
+        assert geometry_type == shapely.GeometryType.POLYGON, f'Rooms of floor {floor_id} are not polygons'
+    else:
+        coords = np.empty((0, 2), dtype=np.float64)
+        ring_offsets = polygon_offsets = np.zeros(1, dtype=np.int64)
+
+    arrays = {
+        'room_ids': np.array(list(room_geometries.keys()), dtype=np.int64),
+        'coords': coords,
+        'ring_offsets': ring_offsets,
+        'polygon_offsets': polygon_offsets,
+    }
+
+    shutil.rmtree(f'{path}.tmp', ignore_errors=True)
+    os.makedirs(f'{path}.tmp')
+    for array_name in FLOOR_ARRAYS:
+        np.save(os.path.join(f'{path}.tmp', f'{array_name}.npy'), arrays[array_name])
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(f'{path}.tmp', path)
+
+    return name
+
+
+def write_index(index: dict, directory: str = PATH_FLOORS_DIR) -> None:
+    '''
+    Replace the index of the floor files in one step, so readers see either all or none of the
+    updated floors, then remove the floor files that are neither in the new nor in the previous
+    index. Readers that did not refresh yet can still load the floors of the previous index.
+
+    Args:
+        index (dict): Hash and name of the floor files by floor ID (str).
+        directory (str): Directory of the floor files.
+
+    Returns:
+        None
+    '''
+
+    previous_index = read_index(directory)
+
+    path = index_path(directory)
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(index, file)
+    os.replace(f'{path}.tmp', path)
+
+    kept = {entry.get('name') for entry in list(index.values()) + list(previous_index.values())}
+    for name in os.listdir(directory):
+        if name == 'index.json' or name in kept:
+            continue
+
+        if os.path.isdir(os.path.join(directory, name)):
+            shutil.rmtree(os.path.join(directory, name))
+        else:
+            os.remove(os.path.join(directory, name))
+
+
+def load_arrays(name: str, directory: str = PATH_FLOORS_DIR, arrays: tuple = FLOOR_ARRAYS, mmap_mode: str = 'r') -> dict:
+    '''
+    Load the arrays of a floor, memory-mapped by default so only the pages that are used are read.
+
+    Args:
+        name (str): Name of the floor files.
+        directory (str): Directory of the floor files.
+        arrays (tuple): Names of the arrays to load.
+        mmap_mode (str): Mode of numpy.load, read into memory if None.
+
+    Returns:
+        dict: Arrays by name.
+    '''
+
+    return {array_name: np.load(os.path.join(directory, name, f'{array_name}.npy'), mmap_mode=mmap_mode) for array_name in arrays}
+
+
+def build_polygons(arrays: dict) -> np.ndarray:
+    '''
+    Build the room polygons of a floor from its packed arrays.
+
+    Args:
+        arrays (dict): Arrays of the floor, see load_arrays.
+
+    Returns:
+        np.ndarray: Room polygons, in the order of the room IDs.
+    '''
+
+    if len(arrays['room_ids']) == 0:
+        return np.empty(0, dtype=object)
+
+    offsets = (np.asarray(arrays['ring_offsets']), np.asarray(arrays['polygon_offsets']))
+    return shapely.from_ragged_array(shapely.GeometryType.POLYGON, np.asarray(arrays['coords']), offsets)
+
+
+def load_floor(floor_id: int, directory: str = PATH_FLOORS_DIR, index: dict = None) -> tuple:
+    '''
+    Load the room geometries of a floor.
+
+    Args:
+        floor_id (int): Floor ID.
+        directory (str): Directory of the floor files.
+        index (dict): Index of the floor files, read if None.
+
+    Returns:
+        room_ids (np.ndarray): Room IDs.
+        polygons (list): Room polygons, in the order of the room IDs.
+    '''
+
+    index = index if index is not None else read_index(directory)
+    arrays = load_arrays(index[str(floor_id)]['name'], directory)
+
+    return np.asarray(arrays['room_ids']), list(build_polygons(arrays))
+
+
+class Floor_Geometries:
+    def __init__(self, directory: str = PATH_FLOORS_DIR, max_floors: int = MAX_CACHED_FLOORS) -> None:
+        '''
+        Floor trees and room IDs of all floors, keyed like the floor trees of the refiner. Only the
+        room IDs are loaded up front, the polygons and tree of a floor are built when it is first
+        used and kept for the max_floors most recently used floors. Refreshing only reloads the
+        floors whose hash changed in the index.
+
+        Args:
+            directory (str): Directory of the floor files.
+            max_floors (int): Floor trees kept in memory.
+
+        Returns:
+            None
+        '''
+
+        self.directory = directory
+        self.max_floors = max_floors
+
+        self.hashes = {} # By floor ID (int)
+        self.names = {} # By floor ID (int)
+        self.room_ids = {} # By floor ID (str), like floorId_to_roomIds.json
+        self.trees = OrderedDict() # By floor ID (int), least recently used first
+
+        self.refresh()
+
+
+    def refresh(self) -> list:
+        '''
+        Load the room IDs of the floors that are new or changed in the index, drop their trees
+        and drop the removed floors.
+
+        Returns:
+            list: IDs of the floors that were changed or removed.
+        '''
+
+        index = read_index(self.directory)
+        changed = [int(floor_id) for floor_id, entry in index.items() if self.hashes.get(int(floor_id)) != entry['hash']]
+
+        for floor_id in changed:
+            entry = index[str(floor_id)]
+            # Read into memory, a memory map per floor would keep a file descriptor open per floor
+            self.room_ids[str(floor_id)] = load_arrays(entry['name'], self.directory, ('room_ids',), mmap_mode=None)['room_ids']
+            self.hashes[floor_id] = entry['hash']
+            self.names[floor_id] = entry['name']
+            self.trees.pop(floor_id, None)
+
+        removed = [floor_id for floor_id in self.hashes if str(floor_id) not in index]
+        for floor_id in removed:
+            del self.hashes[floor_id], self.names[floor_id], self.room_ids[str(floor_id)]
+            self.trees.pop(floor_id, None)
+
+        return changed + removed
+
+
+    def keys(self):
+        return self.names.keys()
+
+
+    def __contains__(self, floor_id: int) -> bool:
+        return floor_id in self.names
+
+
+    def __getitem__(self, floor_id: int) -> STRtree:
+        '''
+        Get the tree of a floor, built on first use.
+
+        Args:
+            floor_id (int): Floor ID.
+
+        Returns:
+            STRtree: Tree of the room polygons, in the order of the room IDs.
+        '''
+
+        if floor_id in self.trees:
+            self.trees.move_to_end(floor_id)
+            return self.trees[floor_id]
+
+        arrays = load_arrays(self.names[floor_id], self.directory)
+        self.trees[floor_id] = STRtree(build_polygons(arrays))
+
+        if len(self.trees) > self.max_floors:
+            self.trees.popitem(last=False)
+
+        return self.trees[floor_id]
+
+
+    def __len__(self) -> int:
+        return len(self.names)
@@ -1,83 +1,125 @@
 import os
-import pickle
 import json
 import yaml
+import argparse
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 
-from pythagoras_api import Pythagoras_API
+from pythagoras_api import Pythagoras_API, get_roomIds_from_workspace
+from response_cache import CACHE_TTL
+from occupancy import build_room_dimension, save_room_dimension, get_department_mappings
+from floor_geometries import PATH_FLOORS_DIR, floor_hash, read_index, write_floor, write_index
 
 from tqdm import tqdm
 from shapely.geometry import Polygon
-from shapely.strtree import STRtree
 import pandas as pd
 
 
 PATH_FLOORPLANS = '../data/floorplans-main'
+PATH_FLOORPLANS_INDEX = '../data/objects/floorplans_index.json'
 
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader) # The libyaml loader, if PyYAML was built with it
 
-def init() -> None:
+
+def init(ttl: int = CACHE_TTL, offline: bool = False) -> None:
     '''
     Initialise necessary files. These include: room geometries, floor trees, 
-    floor to room mappings, and department mappings. Can be run to update the 
-    files.
+    floor to room mappings, department mappings and the room dimension. Every
+    floor is rebuilt, see update.py to only rebuild the floors that changed.
+    Pythagoras responses are cached, so a rerun only downloads what expired
+    and changed.
+
+    Args:
+        ttl (int): Seconds a cached Pythagoras response is used without asking the server.
+        offline (bool): Only use cached Pythagoras responses.
 
     Returns:
         None
     '''
 
-    api = Pythagoras_API()
+    api = Pythagoras_API(ttl=ttl, offline=offline)
     floor_ids = api.get_floor_ids()
 
-    init_saved_objects(floor_ids, api)
-    init_floor_to_rooms_mapping(floor_ids, api)
+    # Every floor is fetched once, the other steps reuse the responses
+    print('Fetching floor information and workspaces...')
+    floor_infos, floor_workspaces = api.fetch_floors(floor_ids)
+
+    floorplans = scan_floorplans()
+
+    update_floor_geometries(floor_infos, floor_workspaces, floorplans, force=True)
+    init_floor_to_rooms_mapping(floor_workspaces)
     init_department_mappings(api)
-    init_floorId_mapId_mapping()
+    init_room_dimension(floor_infos, floor_workspaces)
+    init_floorId_mapId_mapping(floorplans)
+
+    api.close()
 
     print('Initialising necessary files complete.')
 
 
-def init_saved_objects(floor_ids: list, api: Pythagoras_API) -> None:
+def update_floor_geometries(floor_infos: dict, floor_workspaces: dict, floorplans: dict, force: bool = False, directory: str = PATH_FLOORS_DIR) -> list:
     '''
-    Generate and save the room geometries and floor trees for each floor.
+    Generate and save the room geometries of the floors whose workspace data or building offset
+    changed, according to their hashes. Each floor gets its own files and the index is replaced
+    last, so the refiner and the API can swap in the changed floors while running.
+    Floors that are gone or have no offset are removed.
     
     Args:
-        floor_ids (list): List of floor IDs.
+        floor_infos (dict): Floor information by floor ID.
+        floor_workspaces (dict): Workspace data by floor ID.
+        floorplans (dict): Floorplans index, see scan_floorplans.
+        force (bool): Rebuild every floor, whether it changed or not.
+        directory (str): Directory of the floor files.
         
     Returns:
-        None
+        list: IDs of the floors that were rebuilt.
     '''
     print('Generating room geometries and floor trees...')
 
-    room_geometries = {}
-    floor_trees = {}
-    
-    for floor_id in tqdm(floor_ids):
-        data_workspace = api.get_floor_workspace_info(floor_id)
-        data_info = api.get_floor_info(floor_id)
+    os.makedirs(directory, exist_ok=True)
+    index = read_index(directory)
+
+    updated_index = {}
+    changed = []
+
+    for floor_id in tqdm(floor_infos):
+        data_workspace = floor_workspaces[floor_id]
+        data_info = floor_infos[floor_id]
 
         building_id = int(data_info['buildingId'])
-        offset = get_floor_offset(building_id)
+        building = floorplans['buildings'].get(str(building_id))
+        offset = building['offset'] if building is not None else None
         
         if offset is None:
             continue
 
-        current_room_geometries, current_floor_tree = generate_room_geometries(data_workspace, offset)
-        room_geometries.update(current_room_geometries)
-        floor_trees[floor_id] = current_floor_tree
+        hash = floor_hash(data_workspace, offset)
+        entry = index.get(str(floor_id))
+
+        if not force and entry is not None and entry['hash'] == hash:
+            updated_index[str(floor_id)] = entry
+            continue
+
+        room_geometries = generate_room_geometries(data_workspace, offset)
+        name = write_floor(floor_id, hash, room_geometries, directory)
+
+        updated_index[str(floor_id)] = {'hash': hash, 'name': name}
+        changed.append(floor_id)
 
-    with open(f'../data/objects/room_geometries.pkl', 'wb') as file:
-        pickle.dump(room_geometries, file)
+    removed = [floor_id for floor_id in index if floor_id not in updated_index]
+    write_index(updated_index, directory)
 
-    with open(f'../data/objects/floor_trees.pkl', 'wb') as file:
-        pickle.dump(floor_trees, file)
+    print(f'{len(changed)} floors rebuilt, {len(removed)} removed, {len(updated_index) - len(changed)} unchanged')
 
+    return changed
 
-def init_floor_to_rooms_mapping(floor_ids: list, api: Pythagoras_API) -> None:
+
+def init_floor_to_rooms_mapping(floor_workspaces: dict) -> None:
     '''
     Generate and save the mapping of floor IDs to room IDs.
     
     Args:
-        floor_ids (list): List of floor IDs.
-        api (API_Requests): API_Requests object.
+        floor_workspaces (dict): Workspace data by floor ID.
         
     Returns:
         None
@@ -86,12 +128,10 @@ def init_floor_to_rooms_mapping(floor_ids: list, api: Pythagoras_API) -> None:
 
     floorId_to_roomIds = {}
 
-    for floor_id in tqdm(floor_ids):
-        room_ids = api.get_floor_roomIds(floor_id)
-        floorId_to_roomIds[floor_id] = room_ids
+    for floor_id, data_workspace in floor_workspaces.items():
+        floorId_to_roomIds[floor_id] = get_roomIds_from_workspace(data_workspace)
 
-    with open(f'../data/id_mappings/floorId_to_roomIds.json', 'w') as file:
-        json.dump(floorId_to_roomIds, file)
+    write_json(floorId_to_roomIds, '../data/id_mappings/floorId_to_roomIds.json')
 
 
 def init_department_mappings(api: Pythagoras_API) -> None:
@@ -117,71 +157,172 @@ def init_department_mappings(api: Pythagoras_API) -> None:
             'path': org['path'],
         }
 
-    with open(f'../data/id_mappings/department_mappings.json', 'w') as file:
-        json.dump(department_mappings, file)
+    write_json(department_mappings, '../data/id_mappings/department_mappings.json')
 
 
-def init_floorId_mapId_mapping() -> None:
+def init_room_dimension(floor_infos: dict, floor_workspaces: dict) -> None:
+    '''
+    Generate and save the room dimension, i.e. the room, floor, building and owner attributes
+    of every room, used to enrich the occupancy data. Needs the department mappings.
+    
+    Args:
+        floor_infos (dict): Floor information by floor ID.
+        floor_workspaces (dict): Workspace data by floor ID.
+        
+    Returns:
+        None
+    '''
+    print('Generating room dimension...')
+
+    room_dimension = build_room_dimension(floor_infos, floor_workspaces, get_department_mappings())
+    save_room_dimension(room_dimension)
+
+
+def init_floorId_mapId_mapping(floorplans: dict = None) -> None:
     '''
     Generates floorId_to_mapId.json file from the floorplans-main folder.
+
+    Args:
+        floorplans (dict): Floorplans index, scanned if None.
     '''
 
+    floorplans = floorplans if floorplans is not None else scan_floorplans()
+
     floorId_to_mapId = {}
+    for floor_id, floor in floorplans['floors'].items():
+        if floor['mapId'] is not None:
+            floorId_to_mapId[int(floor_id)] = floor['mapId']
 
-    floor_ids = os.listdir(f'{PATH_FLOORPLANS}/floors_by_id')
-    for floor_id in floor_ids:
-        floor_id = int(floor_id)
-        mapId = get_mapId_from_floorId(floor_id)
+    write_json(floorId_to_mapId, '../data/id_mappings/floorId_to_mapId.json')
 
-        if mapId is not None:
-            floorId_to_mapId[floor_id] = mapId
 
-    with open(f'../data/id_mappings/floorId_to_mapId.json', 'w') as file:
-        json.dump(floorId_to_mapId, file)
+def scan_floorplans(path: str = PATH_FLOORPLANS, path_index: str = PATH_FLOORPLANS_INDEX, max_workers: int = None) -> dict:
+    '''
+    Scan the state.yaml files of the floorplans for the map ID of every floor and the offset of
+    every building, into one index. The index keeps the mtime of every file, so only new and
+    modified files are parsed again, in a pool of processes.
+
+    Args:
+        path (str): Path of the floorplans-main folder.
+        path_index (str): Path of the index of the previous scan.
+        max_workers (int): Processes parsing the files, the number of CPUs if None.
+
+    Returns:
+        floorplans (dict): mtime and mapId by floor ID (str) in 'floors', mtime and offset by
+            building ID (str) in 'buildings'.
+    '''
+    print('Scanning floorplans...')
+
+    previous = {'floors': {}, 'buildings': {}}
+    if os.path.exists(path_index):
+        with open(path_index, 'r') as file:
+            previous = json.load(file)
+
+    # Kind of state, with its folder, the value read from it and the function that reads it
+    states = {
+        'floors': ('floors_by_id', 'mapId', get_mapId_from_floorId),
+        'buildings': ('buildings_by_id', 'offset', get_floor_offset),
+    }
+
+    floorplans = {'floors': {}, 'buildings': {}}
+    modified = {'floors': [], 'buildings': []}
+
+    for kind, (folder, key, parse) in states.items():
+        for name in os.listdir(f'{path}/{folder}'):
+            path_state = f'{path}/{folder}/{name}/state.yaml'
+            if not os.path.exists(path_state):
+                continue
+
+            mtime = os.stat(path_state).st_mtime_ns
+            entry = previous[kind].get(name)
+
+            if entry is not None and entry['mtime'] == mtime:
+                floorplans[kind][name] = entry
+            else:
+                modified[kind].append((name, mtime))
+
+    num_modified = len(modified['floors']) + len(modified['buildings'])
+    if num_modified > 0:
+        max_workers = max_workers or os.cpu_count()
+        chunksize = max(1, num_modified // (4 * max_workers))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for kind, (folder, key, parse) in states.items():
+                names = [name for name, mtime in modified[kind]]
+                values = executor.map(parse, names, repeat(path), chunksize=chunksize)
+
+                for (name, mtime), value in zip(modified[kind], values):
+                    floorplans[kind][name] = {'mtime': mtime, key: value}
 
+    print(f'{num_modified} state files parsed, {len(floorplans["floors"]) + len(floorplans["buildings"]) - num_modified} unchanged')
 
-def get_mapId_from_floorId(floor_id: int) -> str:
+    write_json(floorplans, path_index)
+
+    return floorplans
+
+
+def write_json(data: dict, path: str) -> None:
+    '''
+    Write a JSON file in one step, so a running refiner never reads it half written.
+
+    Args:
+        data (dict): Data to write.
+        path (str): Path of the file.
+
+    Returns:
+        None
+    '''
+
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(data, file)
+    os.replace(f'{path}.tmp', path)
+
+
+def get_mapId_from_floorId(floor_id: int, path: str = PATH_FLOORPLANS) -> str:
     '''
     Get the mapId from the floorId.
     
     Args:
         floor_id (int): Floor ID.
+        path (str): Path of the floorplans-main folder.
         
     Returns:
         mapId (str): Map ID.
     '''
 
-    path_floor_state = f'{PATH_FLOORPLANS}/floors_by_id/{floor_id}/state.yaml'
+    path_floor_state = f'{path}/floors_by_id/{floor_id}/state.yaml'
 
     if not os.path.exists(path_floor_state):
         return None
     
     with open(path_floor_state) as file:
-        data = yaml.safe_load(file)
+        data = yaml.load(file, Loader=YAML_LOADER)
     
     mapId = data['mist_mapid']
 
     return mapId
 
 
-def get_floor_offset(building_id: int) -> list:
+def get_floor_offset(building_id: int, path: str = PATH_FLOORPLANS) -> list:
     '''
-    Get the offset of the floor from state.yaml files.
+    Get the offset of the floor from state.yaml files. Use the offsets of scan_floorplans
+    rather than parsing the building state for every floor.
     
     Args:
         building_id (int): Building ID.
+        path (str): Path of the floorplans-main folder.
         
     Returns:
         offset (list): Offset of the floor.
     '''
 
-    path_buildingState = f'{PATH_FLOORPLANS}/buildings_by_id/{building_id}/state.yaml'
+    path_buildingState = f'{path}/buildings_by_id/{building_id}/state.yaml'
 
     if not os.path.exists(path_buildingState):
         return None
 
     with open(path_buildingState) as file:
-        data = yaml.safe_load(file)
+        data = yaml.load(file, Loader=YAML_LOADER)
 
     if data['layout'] is None:
         return None
@@ -192,21 +333,20 @@ def get_floor_offset(building_id: int) -> list:
     return offset
 
 
-def generate_room_geometries(data_workspace: list, offset: list) -> tuple:
+def generate_room_geometries(data_workspace: list, offset: list) -> dict:
     '''
-    Generate the room geometries and floor tree for a floor.
+    Generate the room geometries for a floor. The floor tree is built from them when
+    the floor is loaded.
     
     Args:
         data_workspace (list): Workspace data of the floor.
         offset (list): Offset of the floor.
         
     Returns:
-        room_geometries (dict): Dictionary of room geometries.
-        floor_tree (STRtree): STRtree of room geometries.
+        room_geometries (dict): Dictionary of room geometries, in the order of the workspace data.
     '''
 
     room_geometries = {}
-    current_polygons = []
 
     for room in data_workspace:
         room_id = room['id']
@@ -217,12 +357,14 @@ def generate_room_geometries(data_workspace: list, offset: list) -> tuple:
         
         room_polygon = Polygon(room_coords)
         room_geometries[room_id] = room_polygon
-        current_polygons.append(room_polygon)
-
-    floor_tree = STRtree(current_polygons)
 
-    return room_geometries, floor_tree
+    return room_geometries
 
 
 if __name__ == '__main__':
-    init()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Initialise the files needed for refining and occupancy.')
+    parser.add_argument('--refresh', action='store_true', help='revalidate every cached Pythagoras response')
+    parser.add_argument('--offline', action='store_true', help='only use cached Pythagoras responses')
+    args = parser.parse_args()
+
+    init(ttl=0 if args.refresh else CACHE_TTL, offline=args.offline)
\ No newline at end of file
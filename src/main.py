@@ -1,76 +1,125 @@
-import csv
+import os
+import argparse
 import json
-import pickle
 
-from device import Device
+from device import DeviceStore, rssi_weight, WINDOW, HISTORY_SIZE
+from estimator import update_positions
+from cdf_table import CDF_Table
+from refined_db import Refined_DB_Writer
 from data_api import Data_API
+from floor_geometries import PATH_FLOORS_DIR, Floor_Geometries, index_path
 
-import sqlite3
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
-from shapely.geometry import Polygon, Point
-from shapely.strtree import STRtree
+import shapely
 
 
 ACTIVE_TIME = 3*60 # If devices is not seen for 3 minutes, it is considered inactive -> probably left the building
 ACTIVE_COUNT = 2 # If device is not at least seen 2 times, it is considered inactive -> probably only passing through
 
+NO_ROOM = -1 # Room ID of positions that are not in a room
 
-def generate_refined_data(batch: pd.DataFrame, first_batch: bool = False) -> None:
+CDF_MODE = 'nearest' # Lookup of p-values for z-values, see CDF_Table
+
+ESTIMATORS = ('batched', 'device') # Estimate the positions of all devices at once, or one device at a time
+
+PATH_RECENT_DEVICES = '../data/objects/device_state.db'
+
+
+def generate_refined_data(batch: pd.DataFrame, first_batch: bool = False, estimator: str = 'batched', window: int = WINDOW) -> None:
     '''
     Generate refined data from the batch data, i.e. the data with optimised accuracy and room information.
     
     Args:
         batch (pd.DataFrame): Batch data.
         first_batch (bool): If the batch is the first batch.
+        estimator (str): Position estimator, see get_refined_data.
+        window (int): Maximum number of most recent data points used per position estimate.
         
     Returns:
         None
     '''
 
-    batch = batch.reset_index(drop=True)
-
-    mapId_to_floorId = get_mapId_to_floorId()
-    zValue_to_pValue = get_zValue_to_pValue()
-
-    floorId_to_roomIds = get_floorId_to_roomIds()
-    room_geometries = get_room_geometries()
-    floor_trees = get_floor_trees()
+    reference_data = get_reference_data()
 
     # Get recent devices
     recent_devices = get_recent_devices(first_batch)
+
+    recent_devices, timestamp = refine_batch(batch, recent_devices, reference_data, estimator=estimator, window=window)
+
+    # Save recent devices
+    if timestamp is not None:
+        save_recent_devices(recent_devices, timestamp)
+
+
+def refine_batch(batch: pd.DataFrame, recent_devices: DeviceStore, reference_data: dict, writer: Refined_DB_Writer = None, estimator: str = 'batched', window: int = WINDOW) -> tuple:
+    '''
+    Refine a batch with already loaded reference data and write the refined data to the database.
+
+    Args:
+        batch (pd.DataFrame): Batch data.
+        recent_devices (DeviceStore): Recent devices, updated in place.
+        reference_data (dict): Reference data, see get_reference_data.
+        writer (Refined_DB_Writer): Open database writer, a new connection is used if None.
+        estimator (str): Position estimator, see get_refined_data.
+        window (int): Maximum number of most recent data points used per position estimate.
+
+    Returns:
+        tuple: Updated recent devices and timestamp of the batch (None if the batch is empty).
+    '''
+
+    if len(batch) == 0:
+        return recent_devices, None
+
+    batch = batch.reset_index(drop=True)
+
     # Loading devices in batch
-    devices_in_batch, recent_devices = load_devices_in_batch(batch, recent_devices, mapId_to_floorId)
+    devices_in_batch, recent_devices = load_devices_in_batch(batch, recent_devices, reference_data['mapId_to_floorId'])
 
     # Populate data
     timestamps = batch['timestamp'].to_list()
     timestamp = int(timestamps[-1])
-    data = get_refined_data(devices_in_batch, timestamp, zValue_to_pValue, floorId_to_roomIds, room_geometries, floor_trees)
+    data = get_refined_data(
+        devices_in_batch,
+        timestamp,
+        reference_data['zValue_to_pValue'],
+        reference_data['floor_trees'].room_ids,
+        reference_data['floor_trees'],
+        estimator,
+        window
+    )
 
     # Write to sqlite database
-    add_to_db(data)
+    if writer is None:
+        add_to_db(data)
+    else:
+        writer.insert_batch(data)
 
-    # Save recent devices
-    save_recent_devices(recent_devices, timestamp)
+    return recent_devices, timestamp
 
 
-def get_refined_data(devices_in_batch: dict, timestamp: int, zValue_to_pValue: dict, floorId_to_roomIds: dict, room_geometries: dict, floor_trees: dict) -> dict:
+def get_refined_data(devices_in_batch: dict, timestamp: int, zValue_to_pValue: CDF_Table, floorId_to_roomIds: dict, floor_trees: dict, estimator: str = 'batched', window: int = WINDOW) -> dict:
     '''
     Get refined data from the devices in the batch.
     
     Args:
         devices_in_batch (dict): Devices in the batch.
         timestamp (int): Timestamp of the data.
-        zValue_to_pValue (dict): Mapping of z-values to p-values.
-        floorId_to_roomIds (dict): Mapping of floor IDs to room IDs.
-        room_geometries (dict): Room geometries.
+        zValue_to_pValue (CDF_Table): Lookup of p-values for z-values.
+        floorId_to_roomIds (dict): Mapping of floor IDs to arrays of room IDs.
         floor_trees (dict): Floor trees.
+        estimator (str): 'batched' to estimate all positions at once, 'device' to estimate them per device.
+        window (int): Maximum number of most recent data points used per position estimate, at
+            most HISTORY_SIZE.
         
     Returns:
         dict: Refined data.
     '''
 
+    assert estimator in ESTIMATORS, f'Unknown estimator {estimator}'
+    if window > HISTORY_SIZE:
+        raise ValueError(f'Window of {window} data points is larger than the history of {HISTORY_SIZE}')
+
     data_timestamps = [timestamp for _ in range(len(devices_in_batch))]
     data_mac = []
     data_x, data_y = [], []
@@ -79,6 +128,7 @@ def get_refined_data(devices_in_batch: dict, timestamp: int, zValue_to_pValue: d
     data_floor_id = []
     data_room_id = []
 
+    devices = []
     for device in devices_in_batch.values():
 
         if not device.is_active(ACTIVE_TIME, ACTIVE_COUNT):
@@ -88,28 +138,30 @@ def get_refined_data(devices_in_batch: dict, timestamp: int, zValue_to_pValue: d
         if floor_id not in floor_trees.keys():
             continue
 
-        device.update_position(zValue_to_pValue)
+        devices.append(device)
 
-        floor_tree = floor_trees[floor_id]
-        room_ids = np.array(floorId_to_roomIds[str(floor_id)])
+    if estimator == 'batched' and len(devices) > 0:
+        slots = np.array([device.slot for device in devices])
+        update_positions(devices[0].store, slots, zValue_to_pValue, window)
+    elif estimator == 'device':
+        for device in devices:
+            device.update_position(zValue_to_pValue, window)
 
-        point = Point(device.x, device.y)
-        matches = room_ids.take(floor_tree.query(point))
+    floor_ids = np.array([int(device.floor_ids[-1]) for device in devices], dtype=np.int64)
+    xs = np.array([device.x for device in devices], dtype=np.float64)
+    ys = np.array([device.y for device in devices], dtype=np.float64)
+    room_ids = assign_rooms(xs, ys, floor_ids, floorId_to_roomIds, floor_trees)
 
-        room_id = 'None'
-        for current_room_id in matches:
-            room_geometry = room_geometries[current_room_id]
-            if room_geometry.contains(point):
-                room_id = current_room_id
-                break
+    for i, device in enumerate(devices):
+        room_id = None if room_ids[i] == NO_ROOM else int(room_ids[i])
 
         data_mac.append(device.mac)
         data_x.append(device.x)
         data_y.append(device.y)
         data_error.append(device.error)
         data_rssi.append(device.rssi_values[-1])
-        data_floor_id.append(str(floor_id))
-        data_room_id.append(str(room_id))
+        data_floor_id.append(int(floor_ids[i]))
+        data_room_id.append(room_id)
 
     data = [
         data_timestamps,
@@ -126,13 +178,45 @@ def get_refined_data(devices_in_batch: dict, timestamp: int, zValue_to_pValue: d
     return data
 
 
-def load_devices_in_batch(batch: pd.DataFrame, recent_devices: dict, mapId_to_floorId: dict) -> tuple:
+def assign_rooms(xs: np.ndarray, ys: np.ndarray, floor_ids: np.ndarray, floorId_to_roomIds: dict, floor_trees: dict) -> np.ndarray:
+    '''
+    Find the room of each position, with one bulk STRtree query per floor.
+
+    Args:
+        xs (np.ndarray): x-coordinates.
+        ys (np.ndarray): y-coordinates.
+        floor_ids (np.ndarray): Floor IDs.
+        floorId_to_roomIds (dict): Mapping of floor IDs to arrays of room IDs, in the order of the floor trees.
+        floor_trees (dict): Floor trees.
+
+    Returns:
+        np.ndarray: Room IDs, NO_ROOM if the position is not in a room.
+    '''
+
+    room_ids = np.full(len(xs), NO_ROOM, dtype=np.int64)
+
+    for floor_id in np.unique(floor_ids).tolist():
+        on_floor = np.flatnonzero(floor_ids == floor_id)
+        points = shapely.points(xs[on_floor], ys[on_floor])
+
+        # Pairs of (point, room) with the point within the room, sorted by point
+        point_indices, room_indices = floor_trees[floor_id].query(points, predicate='within')
+
+        # If rooms overlap, the first match is used
+        matched_points, first_matches = np.unique(point_indices, return_index=True)
+        floor_room_ids = floorId_to_roomIds[str(floor_id)]
+        room_ids[on_floor[matched_points]] = floor_room_ids[room_indices[first_matches]]
+
+    return room_ids
+
+
+def load_devices_in_batch(batch: pd.DataFrame, recent_devices: DeviceStore, mapId_to_floorId: dict) -> tuple:
     '''
     Returns list of devices in batch as well as updated recent devices.
     
     Args:
         batch (pd.DataFrame): Batch data.
-        recent_devices (dict): Recent devices.
+        recent_devices (DeviceStore): Recent devices, updated in place.
         mapId_to_floorId (dict): Mapping of map IDs to floor IDs.
         
     Returns:
@@ -140,78 +224,113 @@ def load_devices_in_batch(batch: pd.DataFrame, recent_devices: dict, mapId_to_fl
     '''
 
     devices_in_batch = {}
-    rec_devices = recent_devices.copy()
-
-    for i in range(len(batch)):
-
-        if batch['map_id'][i] not in mapId_to_floorId:
-            print(f'Floor not found for mapId {batch["map_id"][i]}')
-            continue
-
-        if batch['mac'][i] not in rec_devices:
-            rec_devices[batch['mac'][i]] = Device(batch['mac'][i])
 
-        current_device = rec_devices[batch['mac'][i]]
-
-        floor_id = mapId_to_floorId[batch['map_id'][i]]
-        current_device.add_data(
-            float(batch['x'][i]),
-            float(batch['y'][i]),
-            float(batch['rssi'][i]),
-            int(batch['timestamp'][i]),
-            int(floor_id)
-        )
-
-        if current_device.mac not in devices_in_batch:
-            devices_in_batch[current_device.mac] = current_device
+    # Floor ID per row, -1 if the mapId is unknown (the extra -1 also catches missing mapIds with code -1)
+    map_ids = batch['map_id'].astype('category')
+    category_floor_ids = [int(mapId_to_floorId.get(map_id, -1)) for map_id in map_ids.cat.categories]
+    category_floor_ids = np.array(category_floor_ids + [-1], dtype=np.int64)
+    floor_ids = category_floor_ids[map_ids.cat.codes.to_numpy()]
+
+    known = floor_ids != -1
+    if not known.all():
+        unknown_map_ids = map_ids[~known].unique().tolist()
+        print(f'Floor not found for {np.sum(~known)} rows with mapIds {unknown_map_ids}')
+
+    # Rows without a MAC have code -1, which would index the last MAC
+    macs = batch['mac'].astype('category')
+    mac_codes = macs.cat.codes.to_numpy()
+    if (known & (mac_codes == -1)).any():
+        print(f'MAC missing for {np.sum(known & (mac_codes == -1))} rows')
+    known &= mac_codes != -1
+    mac_codes = mac_codes[known]
+    rssi_values = batch['rssi'].to_numpy(dtype=np.float64)[known]
+
+    # Slot per MAC, in order of the first appearance of the devices in the batch
+    unique_codes, first_rows = np.unique(mac_codes, return_index=True)
+    code_slots = np.zeros(len(macs.cat.categories), dtype=np.int64)
+
+    for code in unique_codes[np.argsort(first_rows)].tolist():
+        mac = macs.cat.categories[code]
+
+        if mac not in recent_devices:
+            recent_devices.add_device(mac)
+
+        code_slots[code] = recent_devices.slots[mac]
+        devices_in_batch[mac] = recent_devices[mac]
+
+    recent_devices.append(
+        code_slots[mac_codes],
+        batch['x'].to_numpy(dtype=np.float64)[known],
+        batch['y'].to_numpy(dtype=np.float64)[known],
+        rssi_values,
+        batch['timestamp'].to_numpy(dtype=np.int64)[known],
+        floor_ids[known],
+        rssi_weight(rssi_values)
+    )
 
-    return devices_in_batch, rec_devices 
+    return devices_in_batch, recent_devices 
 
 
 def add_to_db(data: list) -> None:
-    conn = sqlite3.connect('../data/refined_data.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS data_refined (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp INTEGER,
-        mac TEXT,
-        x REAL,
-        y REAL,
-        error REAL,
-        rssi INTEGER,
-        floor_id TEXT,
-        room_id TEXT
-    )
-    ''')
+    '''
+    Add refined data to the database, with a connection of its own.
 
-    cursor.executemany("INSERT INTO data_refined (timestamp, mac, x, y, error, rssi, floor_id, room_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", data)
+    Args:
+        data (list): Refined data.
 
-    conn.commit()
-    conn.close()
+    Returns:
+        None
+    '''
 
+    writer = Refined_DB_Writer()
+    writer.insert_batch(data)
+    writer.close()
 
-def save_recent_devices(recent_devices: dict, timestamp: int) -> None:
+
+def save_recent_devices(recent_devices: DeviceStore, timestamp: int) -> None:
     '''
     Save recent devices and sort out the inactive ones.
     
     Args:
-        recent_devices (dict): Recent devices.
+        recent_devices (DeviceStore): Recent devices.
         timestamp (int): Timestamp of the data.
         
     Returns:
         None
     '''
-    assert type(recent_devices) == dict and type(timestamp) == int, 'Invalid data types'
-    new_recent_devices = {}
+    assert type(recent_devices) == DeviceStore and type(timestamp) == int, 'Invalid data types'
+    recent_devices = prune_recent_devices(recent_devices, timestamp)
+
+    # Only writes the devices that changed since the last save
+    recent_devices.save(PATH_RECENT_DEVICES)
+
+
+def prune_recent_devices(recent_devices: DeviceStore, timestamp: int) -> DeviceStore:
+    '''
+    Sort out the devices that have not been seen for 20 minutes.
+
+    Args:
+        recent_devices (DeviceStore): Recent devices, updated in place.
+        timestamp (int): Timestamp of the data.
+
+    Returns:
+        DeviceStore: Recent devices.
+    '''
+
+    recent_devices.prune(timestamp - 60*20)
+
+    return recent_devices
+
+
+def get_reference_data() -> dict:
+    '''
+    Load all reference data needed to refine a batch.
 
-    for mac, device in recent_devices.items():
-        if device.timestamps[-1] > timestamp - 60*20:
-            new_recent_devices[mac] = device
+    Returns:
+        dict: Reference data, keyed like REFERENCE_FILES.
+    '''
 
-    with open('../data/objects/recent_devices.pkl', 'wb') as file:
-        pickle.dump(new_recent_devices, file)
+    return {name: loader() for name, (path, loader) in REFERENCE_FILES.items()}
 
 
 def get_mapId_to_floorId() -> dict:
@@ -229,22 +348,22 @@ def get_mapId_to_floorId() -> dict:
     return mapId_to_floorId
 
 
-def get_zValue_to_pValue() -> dict:
+def get_zValue_to_pValue() -> CDF_Table:
     '''
-    Get mapping of z-values to p-values.
+    Get lookup of p-values for z-values.
     
     Returns:
-        dict: Mapping of z-values to p-values.
+        CDF_Table: Lookup of p-values for z-values.
     '''
 
     with open('../data/zValue_to_pValue.json', 'r') as file:
         zValue_to_pValue = json.load(file)
         zValue_to_pValue = {float(k): v for k, v in zValue_to_pValue.items()}
 
-    return zValue_to_pValue
+    return CDF_Table(zValue_to_pValue, mode=CDF_MODE)
 
 
-def get_recent_devices(first_batch: bool) -> dict:
+def get_recent_devices(first_batch: bool) -> DeviceStore:
     '''
     Get recent devices.
     
@@ -252,64 +371,52 @@ def get_recent_devices(first_batch: bool) -> dict:
         first_batch (bool): If the batch is the first batch.
     
     Returns:
-        dict: Recent devices.
+        DeviceStore: Recent devices.
     '''
 
     if first_batch:
-        return {}
+        return DeviceStore()
     else:
-        with open('../data/objects/recent_devices.pkl', 'rb') as file:
-            recent_devices = pickle.load(file)
-
-        return recent_devices
-
-
-def get_floorId_to_roomIds() -> dict:
-    '''
-    Get mapping of floor IDs to room IDs.
-    
-    Returns:
-        dict: Mapping of floor IDs to room IDs.
-    '''
-
-    with open('../data/id_mappings/floorId_to_roomIds.json', 'r') as file:
-        floorId_to_roomIds = json.load(file)
-
-    return floorId_to_roomIds
+        return DeviceStore.load(PATH_RECENT_DEVICES)
 
 
-def get_room_geometries() -> dict:
+def get_floor_trees() -> Floor_Geometries:
     '''
-    Get room geometries.
+    Get floor trees, together with the room IDs in the order of the trees.
     
     Returns:
-        dict: Room geometries.
+        Floor_Geometries: Floor trees by floor ID, room IDs by floor ID in room_ids.
     '''
 
-    with open('../data/objects/room_geometries.pkl', 'rb') as file:
-        room_geometries = pickle.load(file)
+    return Floor_Geometries(PATH_FLOORS_DIR)
 
-    return room_geometries
 
+# Reference data with the file it is loaded from, used to reload it when the file changes
+REFERENCE_FILES = {
+    'mapId_to_floorId': ('../data/id_mappings/floorId_to_mapId.json', get_mapId_to_floorId),
+    'zValue_to_pValue': ('../data/zValue_to_pValue.json', get_zValue_to_pValue),
+    'floor_trees': (index_path(PATH_FLOORS_DIR), get_floor_trees),
+}
 
-def get_floor_trees() -> dict:
-    '''
-    Get floor trees.
-    
-    Returns:
-        dict: Floor trees.
-    '''
-    
-    with open('../data/objects/floor_trees.pkl', 'rb') as file:
-        floor_trees = pickle.load(file)
 
-    return floor_trees
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refine the most recent batch of data.')
+    parser.add_argument('--service', action='store_true', help='keep running and refine a new batch every interval')
+    parser.add_argument('--interval', type=int, default=5*60, help='seconds between batches in service mode')
+    parser.add_argument('--window', type=int, default=WINDOW, help=f'most recent data points used per position estimate, at most {HISTORY_SIZE}')
+    args = parser.parse_args()
 
+    if args.window > HISTORY_SIZE:
+        parser.error(f'--window can be at most {HISTORY_SIZE}')
 
-if __name__ == '__main__':
-    data_api = Data_API()
+    first_batch = not os.path.exists(PATH_RECENT_DEVICES)
 
-    batch = data_api.get_last_batch()
-    first_batch = True
+    if args.service:
+        from service import run_service
+        run_service(args.interval, first_batch=first_batch, window=args.window)
+    else:
+        data_api = Data_API()
+        batch = data_api.get_last_batch()
 
-    generate_refined_data(batch=batch, first_batch=first_batch)
\ No newline at end of file
+        generate_refined_data(batch=batch, first_batch=first_batch, window=args.window)
+        data_api.commit_watermark(batch)
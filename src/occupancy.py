@@ -1,55 +1,213 @@
+import os
 import json
 import time
 import sqlite3
+import argparse
 
-from pythagoras_api import Pythagoras_API 
+from refined_arrow import read_columns, iter_chunks
 
 import pandas as pd
-from tqdm import tqdm
 
 
+OCCUPANCY_COLUMNS = ['timestamp', 'floor_id', 'room_id'] # Columns of the refined data needed for occupancy
 
-def generate_occupancy_data(dataframe: pd.DataFrame) -> None:
+BATCH_COLUMNS = ['timestamp', 'date_time', 'num_devices'] # Columns of the occupancy data that are not room attributes
+
+PATH_OCCUPANCY_DB = '../data/occupancy.db'
+PATH_OCCUPANCY_CSV = '../data/occupancy.csv'
+PATH_ROOM_DIMENSION = '../data/objects/room_dimension.db' # Generated by init.py
+
+
+def generate_occupancy_data(chunks, output: str = 'csv') -> None:
     '''
-    Uses the refined data to create 'room summaries' and enrich with pythagoras data.
+    Uses the refined data to create 'room summaries' and enrich with pythagoras data from the room
+    dimension generated by init.py. The data is processed one chunk at a time and appended to the
+    output, so memory use does not grow with the length of the history.
     
     Args:
-        dataframe (pd.DataFrame): Data.
+        chunks (iterable): Chunks of refined data (pd.DataFrame) in chronological order, where the
+            rows of a timestamp are never split over two chunks. A single DataFrame is also accepted.
+        output (str): 'csv' to replace the occupancy CSV, 'db' to add to the occupancy database and
+            advance its watermark past each chunk.
         
     Returns:
         None
     '''
 
-    # splits data into batches
-    batches = []
-    unique_timestamps = dataframe['timestamp'].unique()
-    for timestamp in unique_timestamps:
-        batch = dataframe[dataframe['timestamp'] == timestamp]
-        batches.append(batch)
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
 
     # Loading additional data
-    department_mappings = get_department_mappings()
-    api = Pythagoras_API()
+    room_dimension = get_room_dimension()
+
+    first_chunk = True
+    for chunk in chunks:
+        # Populate the data
+        data = aggregate_occupancy(chunk, room_dimension)
+
+        # Add data to database
+        if output == 'db':
+            add_to_db(data, watermark=int(chunk['timestamp'].max()))
+
+        # Or, add data to CSV
+        else:
+            add_to_csv(data, append=not first_chunk)
+        first_chunk = False
+
+
+def update_occupancy(path: str = PATH_OCCUPANCY_DB) -> None:
+    '''
+    Add the occupancy of the refined data newer than the watermark of the occupancy database.
+    Cheap enough to run after every batch, as only the new snapshots are read.
+
+    Args:
+        path (str): Path of the occupancy database.
+
+    Returns:
+        None
+    '''
+
+    conn = connect_occupancy_db(path)
+    watermark = get_watermark(conn)
+    conn.close()
+
+    start = watermark + 1 if watermark is not None else None
+    generate_occupancy_data(retrieve_data_in_chunks(start), output='db')
+
 
-    floor_infos = {}
-    floor_workspaces = {}
-    for floor_id in tqdm(dataframe['floor_id'].unique()):
-        floor_infos[floor_id] = api.get_floor_info(floor_id)
-        floor_workspaces[floor_id] = api.get_floor_workspace_info(floor_id)
+def aggregate_occupancy(dataframe: pd.DataFrame, room_dimension: pd.DataFrame) -> dict:
+    '''
+    Count the devices per room and timestamp and add the room attributes. Gives the same rows as
+    the previous per-room loop, ordered by timestamp and room id, see
+    tests/occupancy/compare_aggregation.py.
+
+    Args:
+        dataframe (pd.DataFrame): Refined data.
+        room_dimension (pd.DataFrame): Room attributes, see build_room_dimension.
+
+    Returns:
+        dict: Data, with the columns of init_data.
+    '''
+
+    counts = dataframe[dataframe['room_id'].notna()].groupby(['timestamp', 'room_id']).size()
+    counts = counts.rename('num_devices').reset_index()
+    counts['room_id'] = counts['room_id'].astype('int64')
+
+    date_times = {timestamp: convert_timestamp_to_dateTime(timestamp) for timestamp in counts['timestamp'].unique().tolist()}
+    counts['date_time'] = counts['timestamp'].map(date_times)
+
+    occupancy = counts.merge(room_dimension, on='room_id', how='inner')
+
+    return occupancy[list(init_data().keys())].to_dict('list')
+
+
+def build_room_dimension(floor_infos: dict, floor_workspaces: dict, department_mappings: dict) -> pd.DataFrame:
+    '''
+    Resolve the attributes of every room of the given floors once, so they can be joined to the
+    room counts.
+
+    Args:
+        floor_infos (dict): Floor infos.
+        floor_workspaces (dict): Floor workspaces.
+        department_mappings (dict): Department mappings.
+
+    Returns:
+        pd.DataFrame: One row per room with the room, floor, building and owner columns of init_data.
+    '''
 
-    # Populate the data
     data = init_data()
-    data = populate_data(data, batches, floor_infos, floor_workspaces, department_mappings)
+    for column in BATCH_COLUMNS:
+        del data[column]
+
+    for floor_id, floor_info in floor_infos.items():
+        floor_workspace = {item['id']: item for item in floor_workspaces[floor_id]}
+
+        for room_id, room in floor_workspace.items():
+            room_id = int(room_id)
+
+            # room info
+            data['room_id'].append(room_id)
+            data['room_uid'].append(room['uid'])
+            data['room_name'].append(room['name'])
+            data['room_popular_name'].append(room['popularName'])
+            data['room_gross_area'].append(room['grossarea'])
+            data['room_net_area'].append(room['netarea'])
+            data['room_type_id'].append(room['typeId'])
+            data['room_type_name'].append(room['typeName'])
+
+            # floor info
+            data['floor_id'].append(int(floor_id))
+            data['floor_uid'].append(floor_info['uid'])
+            data['floor_name'].append(floor_info['name'])
+            data['floor_popular_name'].append(floor_info['popularName'])
+
+            # celcat info
+            data['celcat_name'].append(f"{floor_info['name']}-{room['name']}")
+
+            # building info
+            data['building_id'].append(floor_info['buildingId'])
+            data['building_uid'].append(floor_info['buildingUid'])
+            data['building_name'].append(floor_info['buildingName'])
+            data['building_popular_name'].append(floor_info['buildingPopularName'])
+
+            # room owner info
+            if 'ownerId' not in room or room['ownerId'] is None:
+                data = add_no_owner_data(data)
+            else:
+                data = add_owner_data(data, floor_workspace, department_mappings, room_id)
+
+    # Object columns keep the values as they are, e.g. 'None' next to integer owner ids
+    return pd.DataFrame(data, dtype=object).astype({'room_id': 'int64'})
 
-    # Add data to database
-    # data = [data[key] for key in data.keys()]
-    # data = list(map(list, zip(*data)))
-    # add_to_db(data)
 
-    # Or, add data to CSV
-    add_to_csv(data)
+def save_room_dimension(room_dimension: pd.DataFrame, path: str = PATH_ROOM_DIMENSION) -> None:
+    '''
+    Save the room dimension to an SQLite database, replacing the previous one atomically. The
+    columns are declared without type, so every value keeps its own type.
 
+    Args:
+        room_dimension (pd.DataFrame): Room attributes, see build_room_dimension.
+        path (str): Path of the database.
 
+    Returns:
+        None
+    '''
+
+    columns = list(room_dimension.columns)
+    column_definitions = ['room_id INTEGER PRIMARY KEY' if column == 'room_id' else column for column in columns]
+    rows = list(zip(*[room_dimension[column].tolist() for column in columns]))
+
+    path_tmp = f'{path}.tmp'
+    if os.path.exists(path_tmp):
+        os.remove(path_tmp)
+
+    conn = sqlite3.connect(path_tmp)
+    with conn:
+        conn.execute(f"CREATE TABLE rooms ({', '.join(column_definitions)})")
+        conn.executemany(f"INSERT INTO rooms ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows)
+    conn.close()
+
+    os.replace(path_tmp, path)
+
+
+def get_room_dimension(path: str = PATH_ROOM_DIMENSION) -> pd.DataFrame:
+    '''
+    Load the room dimension generated by init.py.
+
+    Args:
+        path (str): Path of the database.
+
+    Returns:
+        pd.DataFrame: Room attributes, see build_room_dimension.
+    '''
+
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    cursor = conn.execute('SELECT * FROM rooms')
+    columns = [description[0] for description in cursor.description]
+    rows = cursor.fetchall()
+    conn.close()
+
+    return pd.DataFrame(rows, columns=columns, dtype=object).astype({'room_id': 'int64'})
 
 
 def init_data() -> dict:
@@ -106,165 +264,128 @@ def init_data() -> dict:
     return data
 
 
-def populate_data(data: dict, batches: list, floor_infos: dict, floor_workspaces: dict, department_mappings: dict) -> list:
+def add_to_csv(data: dict, append: bool = False) -> None:
     '''
-    Populates the data dictionary.
+    Write the data to the occupancy CSV.
 
     Args:
-        data (dict): Dictionary.
-        batches (list): List of batches.
-        floor_infos (dict): Floor infos.
-        floor_workspaces (dict): Floor workspaces.
-        department_mappings (dict): Department mappings.
+        data (dict): Data.
+        append (bool): If the data should be appended to the existing CSV instead of replacing it.
 
     Returns:
-        list: Data.
+        None
     '''
 
-    for batch in tqdm(batches):
-        room_ids = batch['room_id'].unique()
-
-        for room_id in room_ids:
-            if room_valid(batch, room_id) == False: continue
-
-            room = batch[batch['room_id'] == room_id]
-            floor_id = room['floor_id'].to_list()[0]
-
-            floor_info = floor_infos[floor_id]
-            floor_workspace = floor_workspaces[floor_id]
-            floor_workspace = {item['id']: item for item in floor_workspace}
-
-            data['timestamp'].append(room['timestamp'].to_list()[0])
-            data['date_time'].append(convert_timestamp_to_dateTime(room['timestamp'].to_list()[0]))
-            data['num_devices'].append(len(room))
-
-            room_id = int(room_id)
-
-            # room info
-            data['room_id'].append(room_id)
-            data['room_uid'].append(floor_workspace[room_id]['uid'])
-            data['room_name'].append(floor_workspace[room_id]['name'])
-            data['room_popular_name'].append(floor_workspace[room_id]['popularName'])
-            data['room_gross_area'].append(floor_workspace[room_id]['grossarea'])
-            data['room_net_area'].append(floor_workspace[room_id]['netarea'])
-            data['room_type_id'].append(floor_workspace[room_id]['typeId'])
-            data['room_type_name'].append(floor_workspace[room_id]['typeName'])
-
-            # floor info
-            data['floor_id'].append(floor_id)
-            data['floor_uid'].append(floor_info['uid'])
-            data['floor_name'].append(floor_info['name'])
-            data['floor_popular_name'].append(floor_info['popularName'])
-
-            # celcat info
-            floor_name = floor_info['name']
-            room_name = floor_workspace[room_id]['name']
-            data['celcat_name'].append(f'{floor_name}-{room_name}')
-
-            # building info
-            data['building_id'].append(floor_info['buildingId'])
-            data['building_uid'].append(floor_info['buildingUid'])
-            data['building_name'].append(floor_info['buildingName'])
-            data['building_popular_name'].append(floor_info['buildingPopularName'])
-
-            # room owner info
-            if 'ownerId' not in floor_workspace[room_id] or floor_workspace[room_id]['ownerId'] is None:
-                data = add_no_owner_data(data)
-            else: 
-                data = add_owner_data(data, floor_workspace, department_mappings, room_id)
-
-
-    return data
-
-
-def add_to_csv(data: dict) -> None:
-    print(data)
     df = pd.DataFrame(data)
     print(df.head())
 
-    df.to_csv('../data/occupancy.csv', index=False)
+    df.to_csv(PATH_OCCUPANCY_CSV, index=False, mode='a' if append else 'w', header=not append)
 
 
-def add_to_db(data: list) -> None:
+def add_to_db(data: dict, watermark: int = None, path: str = PATH_OCCUPANCY_DB) -> None:
     '''
-    Add data to the database.
+    Add data to the database. Rows of a (timestamp, room) that is already in the database are
+    replaced, so adding the same data twice has no effect. The watermark is advanced in the same
+    transaction, so it never gets ahead of the data.
     
     Args:
-        data (list): Data.
+        data (dict): Data.
+        watermark (int): Timestamp up to which the refined data is processed, unchanged if None.
+        path (str): Path of the occupancy database.
         
     Returns:
         None
     '''
 
-    conn = sqlite3.connect('../data/occupancy.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS occupancy (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp INTEGER,
-        date_time TEXT,
-        num_devices INTEGER,
-        room_id TEXT,
-        room_uid TEXT,
-        room_name TEXT,
-        room_popular_name TEXT,
-        room_gross_area REAL,
-        room_net_area REAL,
-        room_type_id INTEGER,
-        room_type_name TEXT,
-        floor_id TEXT,
-        floor_uid TEXT,
-        floor_name TEXT,
-        floor_popular_name TEXT,
-        celcat_name TEXT,
-        building_id TEXT,
-        building_uid TEXT,
-        building_name TEXT,
-        building_popular_name TEXT,
-        room_owner_sub_department_id INTEGER,
-        room_owner_sub_department_code TEXT,
-        room_owner_sub_department_name TEXT,
-        room_owner_department_id INTEGER,
-        room_owner_department_code TEXT,
-        room_owner_department_name TEXT,
-        room_owner_faculty_id INTEGER,
-        room_owner_faculty_code TEXT,
-        room_owner_faculty_name TEXT
-    )
-    ''')
-
-    cursor.executemany(
-        "INSERT INTO occupancy (timestamp, date_time, num_devices, room_id, room_uid, room_name, room_popular_name, celcat_name, room_gross_area, room_net_area, room_type_id, room_type_name, floor_id, floor_uid, floor_name, floor_popular_name, building_id, building_uid, building_name, building_popular_name, room_owner_sub_department_id, room_owner_sub_department_code, room_owner_sub_department_name, room_owner_department_id, room_owner_department_code, room_owner_department_name, room_owner_faculty_id, room_owner_faculty_code, room_owner_faculty_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        data
-    )
-
-    conn.commit()
+    columns = list(data.keys())
+    rows = list(zip(*[data[column] for column in columns]))
+
+    conn = connect_occupancy_db(path)
+
+    with conn:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO occupancy ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            rows
+        )
+
+        if watermark is not None:
+            conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('watermark', MAX(?, COALESCE((SELECT value FROM metadata WHERE key = 'watermark'), ?)))", (watermark, watermark))
+
     conn.close()
 
 
-def room_valid(batch: pd.DataFrame, room_id: str) -> bool:
+def connect_occupancy_db(path: str = PATH_OCCUPANCY_DB) -> sqlite3.Connection:
     '''
-    Check if the room is valid.
-    
+    Open the occupancy database, creating the tables if needed. Databases from before the
+    watermark only get the unique index, after dropping duplicated (timestamp, room) rows.
+
     Args:
-        batch (pd.DataFrame): Batch.
-        room_id (str): Room ID.
-        
+        path (str): Path of the occupancy database.
+
     Returns:
-        bool: True if the room is valid, False otherwise.
+        sqlite3.Connection: Connection.
     '''
 
-    if room_id == 'None':
-        return False
+    conn = sqlite3.connect(path)
+
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS occupancy (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER,
+            date_time TEXT,
+            num_devices INTEGER,
+            room_id TEXT,
+            room_uid TEXT,
+            room_name TEXT,
+            room_popular_name TEXT,
+            room_gross_area REAL,
+            room_net_area REAL,
+            room_type_id INTEGER,
+            room_type_name TEXT,
+            floor_id TEXT,
+            floor_uid TEXT,
+            floor_name TEXT,
+            floor_popular_name TEXT,
+            celcat_name TEXT,
+            building_id TEXT,
+            building_uid TEXT,
+            building_name TEXT,
+            building_popular_name TEXT,
+            room_owner_sub_department_id INTEGER,
+            room_owner_sub_department_code TEXT,
+            room_owner_sub_department_name TEXT,
+            room_owner_department_id INTEGER,
+            room_owner_department_code TEXT,
+            room_owner_department_name TEXT,
+            room_owner_faculty_id INTEGER,
+            room_owner_faculty_code TEXT,
+            room_owner_faculty_name TEXT
+        )
+        ''')
+        conn.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value INTEGER)')
+
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_occupancy_timestamp_room'").fetchone() is None:
+            conn.execute('DELETE FROM occupancy WHERE id NOT IN (SELECT MAX(id) FROM occupancy GROUP BY timestamp, room_id)')
+            conn.execute('CREATE UNIQUE INDEX idx_occupancy_timestamp_room ON occupancy (timestamp, room_id)')
+
+    return conn
+
+
+def get_watermark(conn: sqlite3.Connection) -> int:
+    '''
+    Get the timestamp up to which the refined data is in the occupancy database.
 
-    #room_id = int(room_id)
+    Args:
+        conn (sqlite3.Connection): Connection to the occupancy database.
 
-    room = batch[batch['room_id'] == room_id]
-    if len(room) == 0:
-        return False
+    Returns:
+        int: Watermark, None if nothing was processed yet.
+    '''
 
-    return True
+    row = conn.execute("SELECT value FROM metadata WHERE key = 'watermark'").fetchone()
+
+    return row[0] if row is not None else None
 
 
 def convert_timestamp_to_dateTime(timestamp: int) -> str:
@@ -354,28 +475,44 @@ def add_no_owner_data(data: dict) -> dict:
     return data
 
 
-def retrieve_data_from_db() -> pd.DataFrame:
+def retrieve_data_from_db(start: int = None, end: int = None) -> pd.DataFrame:
     '''
-    Retrieve data from the database.
+    Retrieve the columns needed for occupancy from the refined data, only reading the partitions
+    of the requested days.
+
+    Args:
+        start (int): First timestamp, from the oldest data if None.
+        end (int): Timestamp after the data, up to the most recent data if None.
 
     Returns:
         pd.DataFrame: Data.
     '''
 
-    conn = sqlite3.connect('../data/refined_data.db')
-    cursor = conn.cursor()
+    return read_columns(start, end, OCCUPANCY_COLUMNS)
 
-    cursor.execute("SELECT * FROM data_refined")
-    column_names = [description[0] for description in cursor.description]
-    rows = cursor.fetchall()
 
-    data = pd.DataFrame(rows, columns=column_names)
+def retrieve_data_in_chunks(start: int = None, end: int = None):
+    '''
+    Retrieve the columns needed for occupancy from the refined data, in chunks of CHUNK_SECONDS.
 
-    conn.close()
+    Args:
+        start (int): First timestamp, from the oldest data if None.
+        end (int): Timestamp after the data, up to the most recent data if None.
 
-    return data
+    Returns:
+        iterable: Chunks of data (pd.DataFrame) in chronological order.
+    '''
+
+    return iter_chunks(start, end, OCCUPANCY_COLUMNS)
 
 
 if __name__ == '__main__':
-    df = retrieve_data_from_db()
-    generate_occupancy_data(df)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Convert the refined data to room occupancy.')
+    parser.add_argument('--csv', action='store_true', help='recompute all occupancy into occupancy.csv instead of adding the new data to occupancy.db')
+    args = parser.parse_args()
+
+    if args.csv:
+        chunks = retrieve_data_in_chunks()
+        generate_occupancy_data(chunks)
+    else:
+        update_occupancy()
\ No newline at end of file
@@ -1,36 +1,170 @@
+import json
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from response_cache import PATH_RESPONSE_CACHE, CACHE_TTL, Response_Cache
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from dotenv import dotenv_values
 
 
+BASE_URL = 'https://pim.pythagoras.se/imp_datamanager'
+
+MAX_WORKERS = 8 # Concurrent requests of fetch_floors, also the size of the connection pool
+TIMEOUT = (10, 120) # Seconds to connect and to wait for the response
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5 # Seconds, doubled for every retry
+BACKOFF_MAX = 30 # Seconds
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
 class Pythagoras_API:
-    def __init__(self) -> None:
-        config = dotenv_values("../.env")
+    def __init__(self, base_url: str = BASE_URL, api_key: str = None, max_workers: int = MAX_WORKERS,
+                 cache_path: str = PATH_RESPONSE_CACHE, ttl: int = CACHE_TTL, offline: bool = False) -> None:
+        '''
+        Client of the Pythagoras API. Requests share a pooled session, so connections are reused,
+        and failed requests are retried with jittered exponential backoff.
+        Responses are cached on disk. Fresh responses are used without a request, expired ones are
+        revalidated with their ETag or Last-Modified header where the server sends them.
+
+        Args:
+            base_url (str): URL the API paths are relative to, e.g. of a local stub server.
+            api_key (str): API key, read from .env if None.
+            max_workers (int): Concurrent requests of fetch_floors.
+            cache_path (str): Path of the response cache, no caching if None.
+            ttl (int): Seconds a cached response is used without asking the server.
+            offline (bool): Only use cached responses, whatever their age.
+
+        Returns:
+            None
+        '''
+
+        self.cache = Response_Cache(cache_path, ttl) if cache_path is not None else None
+        self.offline = offline
+
+        if offline:
+            api_key = api_key or ''
+        elif api_key is None:
+            config = dotenv_values("../.env")
+            api_key = config['PYTHAGORAS_API_KEY']
 
-        self.headers = {
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+
+        self.session = requests.Session()
+        self.session.headers.update({
             'Accept': 'application/json',
             'Accept-Encoding': 'gzip, deflate, br',
             'Accept-Language': 'en-GB,en;q=0.9',
-            'api_key': config['PYTHAGORAS_API_KEY'],
-            'Connection': 'keep-alive',
-            'Host': 'pim.pythagoras.se',
-            'Referer': 'https://pim.pythagoras.se/imp_datamanager/api/',
-        }
+            'api_key': api_key,
+            'Referer': f'{self.base_url}/api/',
+        })
+
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def get(self, path: str, params: dict = None):
+        '''
+        Get a JSON response, from the cache if it is fresh there.
+
+        Args:
+            path (str): Path relative to the base URL.
+            params (dict): Query parameters.
+
+        Returns:
+            Decoded JSON response.
+
+        Raises:
+            requests.ConnectionError: If offline and the response is not cached.
+            requests.RequestException: If the request fails, see request.
+        '''
+
+        url = f'{self.base_url}{path}'
+        if self.cache is None:
+            return self.request(url, params).json()
+
+        key = f'{url}?{urlencode(sorted((params or {}).items()))}'
+        entry = self.cache.get(key)
+
+        if entry is not None and (entry['fresh'] or self.offline):
+            return json.loads(entry['body'])
+        if self.offline:
+            raise requests.ConnectionError(f'Offline and {key} is not cached')
+
+        headers = {}
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.request(url, params, headers)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.touch(key)
+            return json.loads(entry['body'])
+
+        data = response.json()
+        self.cache.put(key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+        return data
+
+
+    def request(self, url: str, params: dict = None, headers: dict = None) -> requests.Response:
+        '''
+        Send a GET request, retrying on connection errors, timeouts and the statuses in
+        RETRY_STATUSES. Other error statuses are raised immediately.
+
+        Args:
+            url (str): URL.
+            params (dict): Query parameters.
+            headers (dict): Headers in addition to the ones of the session.
+
+        Returns:
+            requests.Response: Successful or not modified response.
+
+        Raises:
+            requests.RequestException: If the request still fails after MAX_RETRIES retries.
+        '''
+
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = None
+
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == MAX_RETRIES:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    response.raise_for_status()
+                    return response
+
+                retry_after = response.headers.get('Retry-After')
+
+            # Full jitter, so concurrent requests that failed together do not retry together
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, min(BACKOFF_MAX, int(retry_after)))
+
+            time.sleep(delay)
 
 
     def get_floor_ids(self) -> list:
         '''
         Get the list of floor IDs.
-        
+
         Returns:
             floor_ids (list): List of floor IDs.
         '''
 
-        url = 'https://pim.pythagoras.se/imp_datamanager/rest/v1/floor'
-        response = requests.get(url, headers=self.headers)
-
-        assert response.status_code == 200, f'Error: {response.status_code}'
-        floors = response.json()
+        floors = self.get('/rest/v1/floor')
 
         floor_ids = [floor['id'] for floor in floors]
         return floor_ids
@@ -39,40 +173,33 @@ class Pythagoras_API:
     def get_floor_workspace_info(self, floor_id: int) -> list:
         '''
         Get the workspace data for a floor.
-        
+
         Args:
             floor_id (int): Floor ID.
-            
+
         Returns:
             data_workspace (dict): Workspace data for the floor.
         '''
 
-        url = f'https://pim.pythagoras.se/imp_datamanager/rest/v1/floor/{floor_id}/workspace/info?includeOutline=true'
-        response = requests.get(url, headers=self.headers)
-
-        assert response.status_code == 200, f'Error: {response.status_code}'
-        data_workspace = response.json()
+        data_workspace = self.get(f'/rest/v1/floor/{floor_id}/workspace/info', params={'includeOutline': 'true'})
 
         return data_workspace
 
-    
+
     def get_floor_roomIds(self, floor_id: int) -> list:
         '''
-        Get the room IDs for a floor.
-        
+        Get the room IDs for a floor. If the workspace data of the floor is already fetched, use
+        get_roomIds_from_workspace instead.
+
         Args:
             floor_id (int): Floor ID.
-            
+
         Returns:
             room_ids (list): List of room IDs.
         '''
 
-        url = f'https://pim.pythagoras.se/imp_datamanager/rest/v1/floor/{floor_id}/workspace'
-        response = requests.get(url, headers=self.headers)
-
-        assert response.status_code == 200, f'Error: {response.status_code}'
-        workspaces = response.json()
-        room_ids = [workspace['id'] for workspace in workspaces]
+        workspaces = self.get(f'/rest/v1/floor/{floor_id}/workspace')
+        room_ids = get_roomIds_from_workspace(workspaces)
 
         return room_ids
 
@@ -80,19 +207,15 @@ class Pythagoras_API:
     def get_floor_info(self, floor_id: int) -> dict:
         '''
         Get the floor information.
-        
+
         Args:
             floor_id (int): Floor ID.
-            
+
         Returns:
             floor_info (dict): Floor information.
         '''
 
-        url = f'https://pim.pythagoras.se/imp_datamanager/rest/v1/floor/{floor_id}/info'
-        response = requests.get(url, headers=self.headers)
-
-        assert response.status_code == 200, f'Error: {response.status_code}'
-        floor_info = response.json()
+        floor_info = self.get(f'/rest/v1/floor/{floor_id}/info')
 
         return floor_info
 
@@ -100,21 +223,68 @@ class Pythagoras_API:
     def get_organisations(self) -> list:
         '''
         Get the list of organisations.
-        
+
         Returns:
             organisations (list): List of organisations.
         '''
 
-        url = "https://pim.pythagoras.se/imp_datamanager/rest/v1/organisation/info?orderAsc=true"
-        response = requests.get(url, headers=self.headers)
-
-        assert response.status_code == 200, f'Error: {response.status_code}'
-        organisations = response.json()
+        organisations = self.get('/rest/v1/organisation/info', params={'orderAsc': 'true'})
 
         return organisations
 
-# Testing the API_Requests class
+
+    def fetch_floors(self, floor_ids: list) -> tuple:
+        '''
+        Get the floor information and workspace data of many floors, with up to max_workers
+        requests at a time.
+
+        Args:
+            floor_ids (list): List of floor IDs.
+
+        Returns:
+            floor_infos (dict): Floor information by floor ID, in the order of floor_ids.
+            floor_workspaces (dict): Workspace data by floor ID, in the order of floor_ids.
+        '''
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            info_futures = {floor_id: executor.submit(self.get_floor_info, floor_id) for floor_id in floor_ids}
+            workspace_futures = {floor_id: executor.submit(self.get_floor_workspace_info, floor_id) for floor_id in floor_ids}
+
+            floor_infos = {floor_id: future.result() for floor_id, future in info_futures.items()}
+            floor_workspaces = {floor_id: future.result() for floor_id, future in workspace_futures.items()}
+
+        return floor_infos, floor_workspaces
+
+
+    def close(self) -> None:
+        '''
+        Close the pooled connections and the response cache.
+
+        Returns:
+            None
+        '''
+
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+def get_roomIds_from_workspace(data_workspace: list) -> list:
+    '''
+    Get the room IDs of a floor from its workspace data.
+
+    Args:
+        data_workspace (list): Workspace data of the floor.
+
+    Returns:
+        room_ids (list): List of room IDs.
+    '''
+
+    return [workspace['id'] for workspace in data_workspace]
+
+
+# Testing the Pythagoras_API class
 if __name__ == '__main__':
-    api_requests = API_Requests()
-    organisations = api_requests.get_organisations()
-    print(organisations)
\ No newline at end of file
+    api = Pythagoras_API()
+    organisations = api.get_organisations()
+    print(organisations)
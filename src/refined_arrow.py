@@ -0,0 +1,229 @@
+import os
+import argparse
+
+from refined_db import PATH_REFINED_DIR, REFINED_COLUMNS, REFINED_SCHEMA, arrow_path, day_bounds, list_partitions, read_partition, typed_frame
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
+
+
+# Arrow files are memory-mapped, so only the pages of the projected columns are read from disk
+MMAP_FILESYSTEM = fs.LocalFileSystem(use_mmap=True)
+
+CHUNK_SECONDS = 6*60*60 # Time range of the chunks of iter_chunks
+
+
+def list_arrow_files(day: str, start: int = None, end: int = None, directory: str = PATH_REFINED_DIR) -> list:
+    '''
+    List the Arrow files exported for a day with a batch timestamp in a range. The timestamp is
+    part of the file name, so files outside the range are skipped without being opened.
+
+    Args:
+        day (str): Day in UTC, YYYY-MM-DD.
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        list: Paths of the Arrow files, in chronological order.
+    '''
+
+    path_dir = arrow_path(day, directory)
+
+    paths = []
+    for file_name in sorted(os.listdir(path_dir)):
+        if not file_name.endswith('.arrow'):
+            continue
+
+        timestamp = int(file_name.split('-')[0])
+        if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+            continue
+
+        paths.append(os.path.join(path_dir, file_name))
+
+    return paths
+
+
+def timestamp_filter(start: int = None, end: int = None) -> ds.Expression:
+    '''
+    Build the dataset filter of a range of timestamps.
+
+    Args:
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+
+    Returns:
+        ds.Expression: Filter, None if the range is unbounded.
+    '''
+
+    expression = None
+    if start is not None:
+        expression = ds.field('timestamp') >= int(start)
+    if end is not None:
+        upper = ds.field('timestamp') < int(end)
+        expression = upper if expression is None else expression & upper
+
+    return expression
+
+
+def read_unexported(path: str, start: int, end: int, columns: list, exported_ids: pa.Array) -> pd.DataFrame:
+    '''
+    Read the rows of an SQLite partition in a range of timestamps that are not in its exported
+    Arrow files, e.g. rows written before the export was enabled or lost to a failed export.
+    Only the ids are read unless rows are missing.
+
+    Args:
+        path (str): Path of the SQLite partition.
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+        columns (list): Columns to read, including id.
+        exported_ids (pa.Array): Ids of the exported rows in the range.
+
+    Returns:
+        pd.DataFrame: Rows that were not exported, ordered by id.
+    '''
+
+    ids = read_partition(path, start, end, ['id'])['id'].to_numpy()
+    missing = np.setdiff1d(ids, exported_ids.to_numpy(zero_copy_only=False), assume_unique=True)
+
+    if len(missing) == 0:
+        return pd.DataFrame(columns=columns)
+
+    data = read_partition(path, start, end, columns)
+    return data[data['id'].isin(missing)]
+
+
+def read_table(start: int = None, end: int = None, columns: list = None, directory: str = PATH_REFINED_DIR) -> pa.Table:
+    '''
+    Read the refined data in a range of timestamps as an Arrow table. Per day the compacted Parquet
+    partition is read with the filter pushed down to its row groups, and the exported Arrow files
+    are memory-mapped. The Arrow files are a cache of the SQLite partition, rows that were not
+    exported are read from the partition. Days without exported files read their SQLite partition.
+
+    Args:
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+        columns (list): Columns to read, all of REFINED_COLUMNS if None.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        pa.Table: Refined data, in chronological order of the partitions.
+    '''
+
+    columns = columns or REFINED_COLUMNS
+    schema = pa.schema([REFINED_SCHEMA.field(column) for column in columns])
+    expression = timestamp_filter(start, end)
+
+    days = {}
+    for day, path in list_partitions(directory, start, end):
+        days.setdefault(day, []).append(path)
+
+    tables = []
+    for day, paths in days.items():
+        for path in paths:
+            if path.endswith('.parquet'):
+                dataset = ds.dataset(path, schema=REFINED_SCHEMA, format='parquet')
+                tables.append(dataset.to_table(columns=columns, filter=expression))
+
+        # After compaction the exported files only hold the batches that arrived late
+        if os.path.isdir(arrow_path(day, directory)):
+            id_columns = columns if 'id' in columns else columns + ['id']
+            dataset = ds.dataset(list_arrow_files(day, start, end, directory), schema=REFINED_SCHEMA, format='ipc', filesystem=MMAP_FILESYSTEM)
+            exported = dataset.to_table(columns=id_columns, filter=expression)
+
+            for path in paths:
+                if path.endswith('.db'):
+                    unexported = read_unexported(path, start, end, id_columns, exported['id'])
+                    if len(unexported) > 0:
+                        id_schema = pa.schema([REFINED_SCHEMA.field(column) for column in id_columns])
+                        unexported = pa.Table.from_pandas(unexported, schema=id_schema, preserve_index=False)
+                        exported = pa.concat_tables([exported, unexported]).sort_by('id')
+
+            tables.append(exported.select(columns))
+        else:
+            for path in paths:
+                if path.endswith('.db'):
+                    data = read_partition(path, start, end, columns)
+                    tables.append(pa.Table.from_pandas(data, schema=schema, preserve_index=False))
+
+    if len(tables) == 0:
+        return schema.empty_table()
+
+    return pa.concat_tables(tables)
+
+
+def read_columns(start: int = None, end: int = None, columns: list = None, directory: str = PATH_REFINED_DIR) -> pd.DataFrame:
+    '''
+    Read the refined data in a range of timestamps as typed pandas columns.
+
+    Args:
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+        columns (list): Columns to read, all of REFINED_COLUMNS if None.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        pd.DataFrame: Refined data, in chronological order of the partitions.
+    '''
+
+    table = read_table(start, end, columns, directory)
+
+    # Keeps a block per column, so numeric columns are not copied into a consolidated 2D block
+    return typed_frame(table.to_pandas(split_blocks=True))
+
+
+def iter_chunks(start: int = None, end: int = None, columns: list = None, chunk_seconds: int = CHUNK_SECONDS, directory: str = PATH_REFINED_DIR):
+    '''
+    Read the refined data in a range of timestamps as consecutive chunks, so that memory use
+    depends on the chunk size rather than on the length of the range. Chunks cover fixed time
+    ranges, so the rows of a batch are never split over two chunks.
+
+    Args:
+        start (int): First timestamp of the range, from the oldest partition if None.
+        end (int): Timestamp after the range, up to the most recent partition if None.
+        columns (list): Columns to read, all of REFINED_COLUMNS if None.
+        chunk_seconds (int): Time range of a chunk.
+        directory (str): Directory of the partitions.
+
+    Yields:
+        pd.DataFrame: Refined data of a chunk, in chronological order. Empty chunks are skipped.
+    '''
+
+    partitions = list_partitions(directory, start, end)
+    if len(partitions) == 0:
+        return
+
+    start = start if start is not None else day_bounds(partitions[0][0])[0]
+    end = end if end is not None else day_bounds(partitions[-1][0])[1]
+
+    for chunk_start in range(int(start), int(end), chunk_seconds):
+        chunk = read_columns(chunk_start, min(chunk_start + chunk_seconds, end), columns, directory)
+        if len(chunk) > 0:
+            yield chunk
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read the refined data of a range of timestamps.')
+    parser.add_argument('--start', type=int, default=None, help='first unix timestamp, from the oldest data if not given')
+    parser.add_argument('--end', type=int, default=None, help='unix timestamp after the data, up to the most recent data if not given')
+    parser.add_argument('--columns', nargs='+', default=None, choices=REFINED_COLUMNS, help='columns to read, all if not given')
+    parser.add_argument('--output', default=None, help='write the data to a .parquet, .arrow or .csv file instead of printing a summary')
+    args = parser.parse_args()
+
+    table = read_table(args.start, args.end, args.columns)
+
+    if args.output is None:
+        print(table.to_pandas().describe(include='all'))
+        print(f'{table.num_rows} rows')
+    elif args.output.endswith('.parquet'):
+        pq.write_table(table, args.output)
+    elif args.output.endswith('.arrow'):
+        feather.write_feather(table, args.output)
+    else:
+        table.to_pandas().to_csv(args.output, index=False)
@@ -0,0 +1,714 @@
+import os
+import shutil
+import sqlite3
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+
+PATH_REFINED_DB = '../data/refined_data.db' # Single database used before the data was partitioned by day
+PATH_REFINED_DIR = '../data/refined' # One partition per (UTC) day, named YYYY-MM-DD.db or YYYY-MM-DD.parquet once compacted
+
+SCHEMA_VERSION = 3
+BUSY_TIMEOUT = 10 # Seconds a connection waits for a lock before failing
+CACHE_SIZE = 64 * 1024 # Page cache of the writer in KiB
+
+RAW_RETENTION_DAYS = 7 # Days kept as SQLite partitions, older partitions are compacted to Parquet
+RETENTION_DAYS = None # Days kept at all, older partitions are deleted. None keeps everything
+PARQUET_COMPRESSION = 'zstd'
+
+EXPORT_ARROW = True # Also write every batch to an uncompressed Arrow file in arrow/YYYY-MM-DD, which analytics can memory-map
+
+REFINED_COLUMNS = ['id', 'timestamp', 'mac', 'x', 'y', 'error', 'rssi', 'floor_id', 'room_id']
+REFINED_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('timestamp', pa.int64()),
+    ('mac', pa.string()),
+    ('x', pa.float64()),
+    ('y', pa.float64()),
+    ('error', pa.float64()),
+    ('rssi', pa.int64()),
+    ('floor_id', pa.int64()),
+    ('room_id', pa.int64()), # Null if the position is not in a room
+])
+
+
+class Refined_DB_Writer:
+    def __init__(self, directory: str = PATH_REFINED_DIR, export_arrow: bool = EXPORT_ARROW) -> None:
+        '''
+        Keeps a connection to the partition of the current day open for writing batches. Each
+        partition is migrated to the current schema and put in WAL mode, so readers such as the
+        density map API are never blocked by the writer.
+
+        Args:
+            directory (str): Directory of the partitions.
+            export_arrow (bool): If every batch should also be exported to an Arrow file.
+
+        Returns:
+            None
+        '''
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.export_arrow = export_arrow
+        self.day = None
+        self.conn = None
+        self.device_ids = {}
+
+
+    def open_partition(self, day: str) -> None:
+        '''
+        Switch the connection to the partition of a day, creating it if needed.
+
+        Args:
+            day (str): Day of the partition, YYYY-MM-DD.
+
+        Returns:
+            None
+        '''
+
+        if self.conn is not None:
+            self.conn.close()
+
+        self.day = day
+        self.conn = sqlite3.connect(partition_path(day, self.directory), timeout=BUSY_TIMEOUT)
+
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL') # Durable at checkpoints, a crash can only lose the last batches
+        self.conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE}')
+        self.conn.execute('PRAGMA temp_store = MEMORY')
+
+        migrate(self.conn)
+
+        self.device_ids = dict(self.conn.execute('SELECT mac, device_id FROM devices'))
+
+
+    def insert_batch(self, data: list) -> None:
+        '''
+        Insert the refined data of a batch in a single transaction, and register the rows as the
+        snapshot of the batch timestamp. A batch with the timestamp of an earlier batch, e.g. one
+        retried after its watermark could not be committed, replaces the rows of the earlier batch.
+        MACs are stored as ids of the devices table, which are cached for the open partition.
+
+        Args:
+            data (list): Rows of (timestamp, mac, x, y, error, rssi, floor_id, room_id), all with the same
+                timestamp. room_id is None if the position is not in a room.
+
+        Returns:
+            None
+        '''
+
+        if len(data) == 0:
+            return
+
+        timestamp = int(data[0][0])
+        day = partition_day(timestamp)
+        if day != self.day:
+            self.open_partition(day)
+
+        new_macs = list(dict.fromkeys(row[1] for row in data if row[1] not in self.device_ids))
+
+        with self.conn:
+            # The cache is only updated once committed, as the new ids are lost on a rollback
+            device_ids = self.device_ids
+            if len(new_macs) > 0:
+                last_device_id = self.conn.execute('SELECT COALESCE(MAX(device_id), 0) FROM devices').fetchone()[0]
+                self.conn.executemany('INSERT INTO devices (mac) VALUES (?)', [(mac,) for mac in new_macs])
+                device_ids = {**self.device_ids, **dict(self.conn.execute('SELECT mac, device_id FROM devices WHERE device_id > ?', (last_device_id,)))}
+
+            snapshot = self.conn.execute('SELECT first_id, last_id FROM snapshots WHERE timestamp = ?', (timestamp,)).fetchone()
+            if snapshot is not None:
+                self.conn.execute('DELETE FROM data_refined WHERE id BETWEEN ? AND ? AND timestamp = ?', (*snapshot, timestamp))
+
+                # Readers fall back to the database for rows that are not exported, also if the transaction fails
+                path = os.path.join(arrow_path(day, self.directory), f'{timestamp}-{snapshot[0]:012d}.arrow')
+                if os.path.exists(path):
+                    os.remove(path)
+
+            rows = [(row[0], device_ids[row[1]], *row[2:]) for row in data]
+            self.conn.executemany("INSERT INTO data_refined (timestamp, device_id, x, y, error, rssi, floor_id, room_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+            # Rows of a transaction get consecutive ids, as there is only one writer
+            last_id = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            first_id = last_id - len(data) + 1
+
+            self.conn.execute('INSERT OR REPLACE INTO snapshots (timestamp, first_id, last_id, num_rows) VALUES (?, ?, ?, ?)', (timestamp, first_id, last_id, len(data)))
+
+        self.device_ids = device_ids
+
+        # Only exported once committed, so the Arrow files never hold rows the database does not have.
+        # The batch is committed, so a failed export is not raised, readers fall back to the database.
+        if self.export_arrow:
+            try:
+                export_batch(data, first_id, self.directory)
+            except Exception as error:
+                print(f'Failed to export batch {timestamp}: {error!r}')
+
+
+    def close(self) -> None:
+        '''
+        Close the connection.
+
+        Returns:
+            None
+        '''
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.day = None
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    '''
+    Bring the database up to SCHEMA_VERSION. Databases created before the schema was versioned
+    (version 0) already have the data_refined table and only get the indexes. Version 2 adds the
+    snapshots table, which maps each batch timestamp to its range of row ids. Version 3 replaces
+    the MACs by ids of a devices table and stores floor and room ids as integers, with NULL for
+    positions that are not in a room. Row ids are kept, so the snapshots stay valid.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database.
+
+    Returns:
+        None
+    '''
+
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    with conn:
+        if version < 1:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS data_refined (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp INTEGER,
+                mac TEXT,
+                x REAL,
+                y REAL,
+                error REAL,
+                rssi INTEGER,
+                floor_id TEXT,
+                room_id TEXT
+            )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_data_refined_timestamp ON data_refined (timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_data_refined_floor_timestamp ON data_refined (floor_id, timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_data_refined_mac_timestamp ON data_refined (mac, timestamp)')
+
+        if version < 2:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS snapshots (
+                timestamp INTEGER PRIMARY KEY,
+                first_id INTEGER,
+                last_id INTEGER,
+                num_rows INTEGER
+            )
+            ''')
+            conn.execute('''
+            INSERT OR IGNORE INTO snapshots (timestamp, first_id, last_id, num_rows)
+            SELECT timestamp, MIN(id), MAX(id), COUNT(*) FROM data_refined GROUP BY timestamp
+            ''')
+
+        if version < 3:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                device_id INTEGER PRIMARY KEY,
+                mac TEXT UNIQUE
+            )
+            ''')
+            conn.execute('INSERT OR IGNORE INTO devices (mac) SELECT mac FROM data_refined GROUP BY mac ORDER BY MIN(id)')
+
+            conn.execute('''
+            CREATE TABLE data_refined_encoded (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp INTEGER,
+                device_id INTEGER REFERENCES devices (device_id),
+                x REAL,
+                y REAL,
+                error REAL,
+                rssi INTEGER,
+                floor_id INTEGER,
+                room_id INTEGER
+            )
+            ''')
+            conn.execute('''
+            INSERT INTO data_refined_encoded (id, timestamp, device_id, x, y, error, rssi, floor_id, room_id)
+            SELECT data_refined.id, timestamp, device_id, x, y, error, rssi, CAST(floor_id AS INTEGER),
+                CASE WHEN room_id = 'None' THEN NULL ELSE CAST(room_id AS INTEGER) END
+            FROM data_refined JOIN devices USING (mac)
+            ''')
+            conn.execute('DROP TABLE data_refined')
+            conn.execute('ALTER TABLE data_refined_encoded RENAME TO data_refined')
+
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_data_refined_timestamp ON data_refined (timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_data_refined_floor_timestamp ON data_refined (floor_id, timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_data_refined_device_timestamp ON data_refined (device_id, timestamp)')
+
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def connect_reader(path: str) -> sqlite3.Connection:
+    '''
+    Open a read-only connection to the refined data database. In WAL mode it reads the last
+    committed state while batches are being written.
+
+    Args:
+        path (str): Path of the database.
+
+    Returns:
+        sqlite3.Connection: Read-only connection.
+    '''
+
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=BUSY_TIMEOUT)
+
+    return conn
+
+
+def read_partition_snapshot(conn: sqlite3.Connection, timestamp: int = None) -> pd.DataFrame:
+    '''
+    Read the refined data of one batch of a partition through the snapshots table, which only
+    touches the rows of that batch.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database.
+        timestamp (int): Latest batch at or before this timestamp, the most recent batch if None.
+
+    Returns:
+        pd.DataFrame: Refined data of the batch, empty if there is no such batch.
+    '''
+
+    if timestamp is None:
+        snapshot = conn.execute('SELECT timestamp, first_id, last_id FROM snapshots ORDER BY timestamp DESC LIMIT 1').fetchone()
+    else:
+        snapshot = conn.execute('SELECT timestamp, first_id, last_id FROM snapshots WHERE timestamp <= ? ORDER BY timestamp DESC LIMIT 1', (int(timestamp),)).fetchone()
+
+    if snapshot is None:
+        snapshot = (None, 0, -1)
+
+    cursor = conn.execute(f'SELECT {select_columns(REFINED_COLUMNS)} WHERE data_refined.id BETWEEN ? AND ? AND timestamp = ?', (snapshot[1], snapshot[2], snapshot[0]))
+    rows = cursor.fetchall()
+
+    return typed_frame(pd.DataFrame(rows, columns=REFINED_COLUMNS))
+
+
+def select_columns(columns: list) -> str:
+    '''
+    Build the column list and FROM clause of a query of refined data. The devices table is only
+    joined if the MACs are needed.
+
+    Args:
+        columns (list): Columns of REFINED_COLUMNS.
+
+    Returns:
+        str: Columns and FROM clause of a SELECT statement.
+    '''
+
+    expressions = ['devices.mac' if column == 'mac' else f'data_refined.{column}' for column in columns]
+
+    if 'mac' in columns:
+        return f'{", ".join(expressions)} FROM data_refined JOIN devices USING (device_id)'
+
+    return f'{", ".join(expressions)} FROM data_refined'
+
+
+def typed_frame(data: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Give the floor and room ids of refined data their types, as missing rooms would otherwise
+    turn the room ids into floats.
+
+    Args:
+        data (pd.DataFrame): Refined data.
+
+    Returns:
+        pd.DataFrame: Refined data with int64 floor ids and nullable Int64 room ids.
+    '''
+
+    if 'floor_id' in data.columns:
+        data['floor_id'] = data['floor_id'].astype('int64')
+    if 'room_id' in data.columns:
+        data['room_id'] = data['room_id'].astype('Int64')
+
+    return data
+
+
+def partition_day(timestamp: int) -> str:
+    '''
+    Get the day of the partition a timestamp belongs to.
+
+    Args:
+        timestamp (int): Unix timestamp.
+
+    Returns:
+        str: Day in UTC, YYYY-MM-DD.
+    '''
+
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+
+def day_bounds(day: str) -> tuple:
+    '''
+    Get the range of timestamps of a day.
+
+    Args:
+        day (str): Day in UTC, YYYY-MM-DD.
+
+    Returns:
+        tuple: First timestamp of the day and first timestamp of the next day.
+    '''
+
+    start = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
+
+def partition_path(day: str, directory: str = PATH_REFINED_DIR, extension: str = 'db') -> str:
+    '''
+    Get the path of the partition of a day.
+
+    Args:
+        day (str): Day in UTC, YYYY-MM-DD.
+        directory (str): Directory of the partitions.
+        extension (str): 'db' for SQLite partitions, 'parquet' for compacted partitions.
+
+    Returns:
+        str: Path of the partition.
+    '''
+
+    return os.path.join(directory, f'{day}.{extension}')
+
+
+def arrow_path(day: str, directory: str = PATH_REFINED_DIR) -> str:
+    '''
+    Get the directory of the Arrow files exported for a day.
+
+    Args:
+        day (str): Day in UTC, YYYY-MM-DD.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        str: Directory of the Arrow files.
+    '''
+
+    return os.path.join(directory, 'arrow', day)
+
+
+def export_batch(data: list, first_id: int, directory: str = PATH_REFINED_DIR) -> None:
+    '''
+    Write the refined data of a batch to an uncompressed Arrow (Feather v2) file, named after the
+    timestamp and first id of the batch so the files of a day sort chronologically.
+
+    Args:
+        data (list): Rows of (timestamp, mac, x, y, error, rssi, floor_id, room_id), all with the same timestamp.
+        first_id (int): Id of the first row in the database.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        None
+    '''
+
+    timestamp = int(data[0][0])
+    path_dir = arrow_path(partition_day(timestamp), directory)
+    os.makedirs(path_dir, exist_ok=True)
+
+    columns = list(zip(*data))
+    arrays = [pa.array(range(first_id, first_id + len(data)), pa.int64())]
+    arrays += [pa.array(column, field.type) for column, field in zip(columns, list(REFINED_SCHEMA)[1:])]
+    table = pa.Table.from_arrays(arrays, schema=REFINED_SCHEMA)
+
+    path = os.path.join(path_dir, f'{timestamp}-{first_id:012d}.arrow')
+    feather.write_feather(table, f'{path}.tmp', compression='uncompressed')
+    os.replace(f'{path}.tmp', path)
+
+
+def list_partitions(directory: str = PATH_REFINED_DIR, start: int = None, end: int = None) -> list:
+    '''
+    List the partitions that can hold data in a range of timestamps. A day can have both an SQLite
+    and a Parquet partition if late data arrived after it was compacted.
+
+    Args:
+        directory (str): Directory of the partitions.
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+
+    Returns:
+        list: (day, path) tuples, in chronological order.
+    '''
+
+    if not os.path.isdir(directory):
+        return []
+
+    partitions = []
+    for file_name in os.listdir(directory):
+        day, extension = os.path.splitext(file_name)
+        if extension not in ('.db', '.parquet'):
+            continue
+
+        day_start, day_end = day_bounds(day)
+        if (start is not None and day_end <= start) or (end is not None and day_start >= end):
+            continue
+
+        partitions.append((day, os.path.join(directory, file_name)))
+
+    # A Parquet partition holds older data than an SQLite partition of the same day
+    return sorted(partitions, key=lambda partition: (partition[0], partition[1].endswith('.db')))
+
+
+def read_partition(path: str, start: int = None, end: int = None, columns: list = None) -> pd.DataFrame:
+    '''
+    Read the refined data of a partition in a range of timestamps.
+
+    Args:
+        path (str): Path of an SQLite or Parquet partition.
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+        columns (list): Columns to read, all of REFINED_COLUMNS if None.
+
+    Returns:
+        pd.DataFrame: Refined data, ordered by id.
+    '''
+
+    columns = columns or REFINED_COLUMNS
+
+    if path.endswith('.parquet'):
+        filters = []
+        if start is not None:
+            filters.append(('timestamp', '>=', start))
+        if end is not None:
+            filters.append(('timestamp', '<', end))
+
+        table = pq.read_table(path, columns=columns, filters=filters or None)
+
+        return typed_frame(table.to_pandas())
+
+    # Cast as NumPy integers would be bound as blobs
+    start = int(start) if start is not None else -2**63
+    end = int(end) if end is not None else 2**63 - 1
+
+    conn = connect_reader(path)
+    cursor = conn.execute(f'SELECT {select_columns(columns)} WHERE timestamp >= ? AND timestamp < ? ORDER BY data_refined.id', (start, end))
+    data = pd.DataFrame(cursor.fetchall(), columns=columns)
+    conn.close()
+
+    return typed_frame(data)
+
+
+def read_range(start: int = None, end: int = None, columns: list = None, directory: str = PATH_REFINED_DIR) -> pd.DataFrame:
+    '''
+    Read the refined data in a range of timestamps, opening only the partitions of the days in the range.
+
+    Args:
+        start (int): First timestamp of the range, unbounded if None.
+        end (int): Timestamp after the range, unbounded if None.
+        columns (list): Columns to read, all of REFINED_COLUMNS if None.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        pd.DataFrame: Refined data, in chronological order of the partitions.
+    '''
+
+    columns = columns or REFINED_COLUMNS
+
+    partitions = [read_partition(path, start, end, columns) for day, path in list_partitions(directory, start, end)]
+    partitions = [partition for partition in partitions if len(partition) > 0]
+    if len(partitions) == 0:
+        return typed_frame(pd.DataFrame(columns=columns))
+
+    return pd.concat(partitions, ignore_index=True)
+
+
+def read_snapshot(timestamp: int = None, directory: str = PATH_REFINED_DIR) -> pd.DataFrame:
+    '''
+    Read the refined data of the latest batch at or before a timestamp. Partitions are searched
+    from the day of the timestamp backwards, so usually only one partition is opened.
+
+    Args:
+        timestamp (int): Latest batch at or before this timestamp, the most recent batch if None.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        pd.DataFrame: Refined data of the batch, empty if there is no such batch.
+    '''
+
+    end = timestamp + 1 if timestamp is not None else None
+    partitions = list_partitions(directory, end=end)
+
+    while len(partitions) > 0:
+        day = partitions[-1][0]
+        paths = [path for partition_day, path in partitions if partition_day == day]
+        partitions = partitions[:-len(paths)]
+
+        snapshots = []
+        for path in paths:
+            if path.endswith('.parquet'):
+                timestamps = read_partition(path, end=end, columns=['timestamp'])['timestamp']
+                if len(timestamps) > 0:
+                    latest = int(timestamps.max())
+                    snapshots.append(read_partition(path, latest, latest + 1))
+            else:
+                conn = connect_reader(path)
+                snapshots.append(read_partition_snapshot(conn, timestamp))
+                conn.close()
+
+        snapshots = [snapshot for snapshot in snapshots if len(snapshot) > 0]
+        if len(snapshots) > 0:
+            latest = max(snapshot['timestamp'].iloc[0] for snapshot in snapshots)
+            return pd.concat([snapshot for snapshot in snapshots if snapshot['timestamp'].iloc[0] == latest], ignore_index=True)
+
+    return typed_frame(pd.DataFrame(columns=REFINED_COLUMNS))
+
+
+def compact_partitions(directory: str = PATH_REFINED_DIR, raw_days: int = RAW_RETENTION_DAYS, now: int = None) -> None:
+    '''
+    Rewrite the SQLite partitions older than raw_days as compressed Parquet partitions. The Parquet
+    file is complete before the SQLite partition is removed, so readers always see the data.
+
+    Args:
+        directory (str): Directory of the partitions.
+        raw_days (int): Days kept as SQLite partitions.
+        now (int): Current timestamp, the time of the call if None.
+
+    Returns:
+        None
+    '''
+
+    now = now if now is not None else int(datetime.now(timezone.utc).timestamp())
+    oldest_raw = partition_day(now - raw_days * 24*60*60)
+
+    for day, path in list_partitions(directory):
+        if day >= oldest_raw or not path.endswith('.db'):
+            continue
+
+        data = read_partition(path)
+        path_parquet = partition_path(day, directory, 'parquet')
+        if os.path.exists(path_parquet):
+            # Late data of a day that was already compacted
+            data = pd.concat([read_partition(path_parquet), data], ignore_index=True)
+
+        table = pa.Table.from_pandas(data, schema=REFINED_SCHEMA, preserve_index=False)
+        pq.write_table(table, f'{path_parquet}.tmp', compression=PARQUET_COMPRESSION)
+        os.replace(f'{path_parquet}.tmp', path_parquet)
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+        # The exported batches are in the Parquet partition now
+        shutil.rmtree(arrow_path(day, directory), ignore_errors=True)
+
+        print(f'Compacted {path} ({len(data)} rows)')
+
+
+def apply_retention(directory: str = PATH_REFINED_DIR, days: int = RETENTION_DAYS, now: int = None) -> None:
+    '''
+    Delete the partitions older than the retention period.
+
+    Args:
+        directory (str): Directory of the partitions.
+        days (int): Days of data kept, nothing is deleted if None.
+        now (int): Current timestamp, the time of the call if None.
+
+    Returns:
+        None
+    '''
+
+    if days is None:
+        return
+
+    now = now if now is not None else int(datetime.now(timezone.utc).timestamp())
+    oldest = partition_day(now - days * 24*60*60)
+
+    for day, path in list_partitions(directory):
+        if day >= oldest:
+            continue
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        shutil.rmtree(arrow_path(day, directory), ignore_errors=True)
+
+        print(f'Deleted {path}')
+
+
+def maintain_partitions(directory: str = PATH_REFINED_DIR, raw_days: int = RAW_RETENTION_DAYS, days: int = RETENTION_DAYS, now: int = None) -> None:
+    '''
+    Compact the old partitions and delete the expired ones. The partition of the day of now is
+    never touched, so now should be the timestamp of the last batch while the writer is running.
+
+    Args:
+        directory (str): Directory of the partitions.
+        raw_days (int): Days kept as SQLite partitions.
+        days (int): Days of data kept, nothing is deleted if None.
+        now (int): Current timestamp, the time of the call if None.
+
+    Returns:
+        None
+    '''
+
+    compact_partitions(directory, raw_days, now)
+    apply_retention(directory, days, now)
+
+
+def migrate_legacy_db(path: str = PATH_REFINED_DB, directory: str = PATH_REFINED_DIR) -> None:
+    '''
+    Move the rows of the single refined data database into day partitions. The database is renamed
+    afterwards, so the rows are not moved twice.
+
+    Args:
+        path (str): Path of the single database.
+        directory (str): Directory of the partitions.
+
+    Returns:
+        None
+    '''
+
+    conn = connect_reader(path)
+    writer = Refined_DB_Writer(directory)
+
+    cursor = conn.execute('''
+    SELECT timestamp, mac, x, y, error, rssi, CAST(floor_id AS INTEGER),
+        CASE WHEN room_id = 'None' THEN NULL ELSE CAST(room_id AS INTEGER) END
+    FROM data_refined ORDER BY id
+    ''')
+    batch = []
+    num_rows = 0
+    while True:
+        rows = cursor.fetchmany(10000)
+        for row in rows:
+            # The rows of a batch are consecutive and share a timestamp
+            if len(batch) > 0 and row[0] != batch[0][0]:
+                writer.insert_batch(batch)
+                batch = []
+            batch.append(row)
+
+        num_rows += len(rows)
+        if len(rows) == 0:
+            break
+
+    writer.insert_batch(batch)
+    writer.close()
+    conn.close()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.replace(path + suffix, f'{path}.migrated{suffix}')
+    print(f'Moved {num_rows} rows from {path} to {directory}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the partitions of the refined data.')
+    parser.add_argument('--raw_days', type=int, default=RAW_RETENTION_DAYS, help='days kept as SQLite partitions before compaction')
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS, help='days of data kept, everything if not given')
+    args = parser.parse_args()
+
+    if os.path.exists(PATH_REFINED_DB):
+        migrate_legacy_db()
+
+    maintain_partitions(raw_days=args.raw_days, days=args.days)
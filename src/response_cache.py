@@ -0,0 +1,172 @@
+import os
+import time
+import zlib
+import sqlite3
+import threading
+
+
+PATH_RESPONSE_CACHE = '../data/cache/pythagoras_api.db'
+
+CACHE_TTL = 7*24*60*60 # Seconds a response is used without asking the server
+CACHE_MAX_BYTES = 512*1024*1024 # Compressed size of the responses, least recently used ones are evicted above it
+
+
+class Response_Cache:
+    def __init__(self, path: str = PATH_RESPONSE_CACHE, ttl: int = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        '''
+        Persistent cache of API responses in a SQLite database, keyed by URL and parameters. Besides
+        the compressed body, the ETag and Last-Modified headers are kept, so expired responses can
+        be revalidated instead of downloaded again. Can be shared between threads. The access times
+        of cache hits are kept in memory and written with the next put or on close, so hits do not
+        commit.
+
+        Args:
+            path (str): Path of the cache database.
+            ttl (int): Seconds a response is fresh.
+            max_bytes (int): Compressed size of all responses above which the least recently used are evicted.
+
+        Returns:
+            None
+        '''
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.accessed = {} # Access times by key, not written yet
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)')
+        self.conn.commit()
+
+
+    def get(self, key: str) -> dict:
+        '''
+        Get a cached response and mark it as recently used.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            entry (dict): body (bytes), etag, last_modified and fresh (bool), None if not cached.
+        '''
+
+        with self.lock:
+            row = self.conn.execute('SELECT body, etag, last_modified, fetched_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            now = time.time()
+            self.accessed[key] = now
+
+        body, etag, last_modified, fetched_at = row
+        return {
+            'body': zlib.decompress(body),
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': now - fetched_at < self.ttl,
+        }
+
+
+    def put(self, key: str, body: bytes, etag: str = None, last_modified: str = None) -> None:
+        '''
+        Cache a response, then evict the least recently used responses if the cache is too large.
+
+        Args:
+            key (str): Cache key.
+            body (bytes): Response body.
+            etag (str): ETag header of the response.
+            last_modified (str): Last-Modified header of the response.
+
+        Returns:
+            None
+        '''
+
+        body = zlib.compress(body)
+        now = time.time()
+
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)', (key, body, etag, last_modified, now, now, len(body)))
+            self.accessed.pop(key, None)
+            self.evict()
+            self.conn.commit()
+
+
+    def touch(self, key: str) -> None:
+        '''
+        Make a cached response fresh again, after the server confirmed it did not change.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            None
+        '''
+
+        with self.lock:
+            now = time.time()
+            self.conn.execute('UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE key = ?', (now, now, key))
+            self.accessed.pop(key, None)
+            self.conn.commit()
+
+
+    def evict(self) -> None:
+        '''
+        Delete the least recently used responses until the cache is within max_bytes. Called
+        with the lock held, the caller commits.
+
+        Returns:
+            None
+        '''
+
+        self.write_accessed()
+
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall():
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+    def write_accessed(self) -> None:
+        '''
+        Write the access times of the cache hits since the last write. Called with the lock held,
+        the caller commits.
+
+        Returns:
+            None
+        '''
+
+        self.conn.executemany('UPDATE responses SET accessed_at = ? WHERE key = ?', [(accessed_at, key) for key, accessed_at in self.accessed.items()])
+        self.accessed = {}
+
+
+    def close(self) -> None:
+        '''
+        Write the pending access times and close the cache database.
+
+        Returns:
+            None
+        '''
+
+        with self.lock:
+            self.write_accessed()
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,183 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from device import WINDOW
+from main import REFERENCE_FILES, refine_batch, get_recent_devices, prune_recent_devices, save_recent_devices
+from data_api import Data_API
+from refined_db import Refined_DB_Writer, maintain_partitions
+
+import pandas as pd
+
+
+class Reference_Data:
+    def __init__(self) -> None:
+        '''
+        Keeps the reference data needed for refining in memory and reloads a file only
+        when it changed on disk, e.g. after init.py was run.
+
+        Returns:
+            None
+        '''
+
+        self.data = {}
+        self.mtimes = {}
+
+        self.refresh()
+
+
+    def refresh(self) -> None:
+        '''
+        Reload the reference data whose files were modified since they were last loaded.
+
+        Returns:
+            None
+        '''
+
+        for name, (path, loader) in REFERENCE_FILES.items():
+            mtime = os.stat(path).st_mtime_ns
+            if self.mtimes.get(name) == mtime:
+                continue
+
+            print(f'Loading {path}')
+            if hasattr(self.data.get(name), 'refresh'):
+                # Only the changed parts are loaded, e.g. the floors with a new hash
+                self.data[name].refresh()
+            else:
+                self.data[name] = loader()
+            self.mtimes[name] = mtime
+
+
+class Refiner:
+    def __init__(self, first_batch: bool = False, window: int = WINDOW) -> None:
+        '''
+        Refines consecutive batches while keeping the reference data, recent devices and the database
+        connection in memory.
+        The recent devices are checkpointed in the background after every batch, and the refined data
+        partitions are compacted in the background whenever a new day starts.
+
+        Args:
+            first_batch (bool): If there are no recent devices to continue from.
+            window (int): Maximum number of most recent data points used per position estimate.
+
+        Returns:
+            None
+        '''
+
+        self.reference_data = Reference_Data()
+        self.recent_devices = get_recent_devices(first_batch)
+        self.window = window
+
+        # Raised here, as every batch would fail
+        if window > self.recent_devices.history_size:
+            raise ValueError(f'Window of {window} data points is larger than the history of {self.recent_devices.history_size}')
+        self.writer = Refined_DB_Writer()
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.checkpoint = None
+
+
+    def process_batch(self, batch: pd.DataFrame) -> None:
+        '''
+        Refine a batch and checkpoint the recent devices asynchronously.
+
+        Args:
+            batch (pd.DataFrame): Batch data.
+
+        Returns:
+            None
+        '''
+
+        self.reference_data.refresh()
+
+        # The devices must not change while the previous checkpoint is being written
+        self.wait_for_checkpoint()
+
+        # Restored if the batch fails before its rows are committed, as the batch is fetched again
+        # and its data points would otherwise be added twice
+        recent_devices = self.recent_devices.copy()
+
+        day = self.writer.day
+        try:
+            self.recent_devices, timestamp = refine_batch(batch, self.recent_devices, self.reference_data.data, self.writer, window=self.window)
+        except Exception:
+            self.recent_devices = recent_devices
+            raise
+
+        if timestamp is None:
+            return
+
+        self.recent_devices = prune_recent_devices(self.recent_devices, timestamp)
+        self.checkpoint = self.executor.submit(save_recent_devices, self.recent_devices, timestamp)
+
+        # Relative to the batch, so the partition that is being written is never compacted
+        if self.writer.day != day:
+            self.executor.submit(maintain_partitions, self.writer.directory, now=timestamp)
+
+
+    def wait_for_checkpoint(self) -> None:
+        '''
+        Wait for the running checkpoint, if any, to be written. A failed checkpoint is only logged,
+        the devices it did not write are still marked as changed and written by the next one.
+
+        Returns:
+            None
+        '''
+
+        if self.checkpoint is None:
+            return
+
+        try:
+            self.checkpoint.result()
+        except Exception as error:
+            print(f'Failed to checkpoint recent devices: {error!r}')
+        finally:
+            self.checkpoint = None
+
+
+    def close(self) -> None:
+        '''
+        Finish the running checkpoint, stop the background thread and close the database.
+
+        Returns:
+            None
+        '''
+
+        self.wait_for_checkpoint()
+        self.executor.shutdown()
+        self.writer.close()
+
+
+def run_service(interval: int, first_batch: bool = False, window: int = WINDOW) -> None:
+    '''
+    Fetch and refine a new batch every interval until interrupted.
+
+    Args:
+        interval (int): Seconds between the start of two batches.
+        first_batch (bool): If there are no recent devices to continue from.
+        window (int): Maximum number of most recent data points used per position estimate.
+
+    Returns:
+        None
+    '''
+
+    data_api = Data_API()
+    refiner = Refiner(first_batch, window)
+
+    next_run = time.monotonic()
+
+    try:
+        while True:
+            try:
+                batch = data_api.get_last_batch()
+                refiner.process_batch(batch)
+                data_api.commit_watermark(batch)
+            except Exception as error:
+                # Keep the service running, the batch is fetched again in the next run
+                print(f'Failed to process batch: {error!r}')
+
+            # Skip the runs that were missed if a batch took longer than the interval
+            next_run = max(next_run + interval, time.monotonic())
+            time.sleep(next_run - time.monotonic())
+    finally:
+        refiner.close()
@@ -0,0 +1,49 @@
+import argparse
+
+from pythagoras_api import Pythagoras_API
+from init import scan_floorplans, update_floor_geometries, init_floor_to_rooms_mapping, init_department_mappings, init_room_dimension, init_floorId_mapId_mapping
+
+
+def update(ttl: int = 0, offline: bool = False) -> None:
+    '''
+    Update the necessary files after changes in Pythagoras, while the refiner and the API keep
+    running. Only the floors whose workspace data or building offset changed get new room
+    geometries and floor trees, the running refiner and API swap in just those floors.
+    The other files are small and rebuilt from the same responses.
+
+    Args:
+        ttl (int): Seconds a cached Pythagoras response is used without asking the server. By
+            default every response is revalidated, which is cheap for the unchanged ones.
+        offline (bool): Only use cached Pythagoras responses.
+
+    Returns:
+        None
+    '''
+
+    api = Pythagoras_API(ttl=ttl, offline=offline)
+    floor_ids = api.get_floor_ids()
+
+    print('Fetching floor information and workspaces...')
+    floor_infos, floor_workspaces = api.fetch_floors(floor_ids)
+
+    # Only the floorplans modified since the last scan are parsed
+    floorplans = scan_floorplans()
+
+    update_floor_geometries(floor_infos, floor_workspaces, floorplans)
+    init_floor_to_rooms_mapping(floor_workspaces)
+    init_department_mappings(api)
+    init_room_dimension(floor_infos, floor_workspaces)
+    init_floorId_mapId_mapping(floorplans)
+
+    api.close()
+
+    print('Updating necessary files complete.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the files of the floors that changed in Pythagoras.')
+    parser.add_argument('--ttl', type=int, default=0, help='seconds a cached Pythagoras response is used without asking the server')
+    parser.add_argument('--offline', action='store_true', help='only use cached Pythagoras responses')
+    args = parser.parse_args()
+
+    update(ttl=args.ttl, offline=args.offline)
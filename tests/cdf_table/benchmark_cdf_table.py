@@ -0,0 +1,84 @@
+'''
+Accuracy of the CDF_Table lookups against zValue_to_pValue.json and the previous
+Device.closest_cdf, and the time per lookup.
+'''
+
+import sys
+sys.path.append('../../src')
+
+import json
+import time
+import bisect
+
+import numpy as np
+
+from cdf_table import CDF_Table
+
+
+NUM_LOOKUPS = 100000
+
+
+def legacy_closest_cdf(z_value, table):
+    '''
+    The previous Device.closest_cdf.
+    '''
+
+    z_values = list(table.keys())
+    closest_index = bisect.bisect_left(z_values, z_value)
+
+    if closest_index == 0:
+        return table[z_values[0]]
+    elif closest_index == len(z_values):
+        return table[z_values[-1]]
+    else:
+        lower_value = z_values[closest_index - 1]
+        upper_value = z_values[closest_index]
+
+        if abs(z_value - lower_value) < abs(z_value - upper_value):
+            return table[lower_value]
+        else:
+            return table[upper_value]
+
+
+def check_accuracy(table, z_values):
+    keys = np.array(list(table.keys()))
+    values = np.array(list(table.values()))
+    legacy = np.array([legacy_closest_cdf(z, table) for z in z_values])
+
+    nearest = CDF_Table(table, mode='nearest')
+    assert np.array_equal(nearest(z_values), legacy), 'nearest differs from closest_cdf'
+    assert np.array_equal([nearest(z) for z in z_values], legacy), 'nearest (scalar) differs from closest_cdf'
+    assert np.array_equal(nearest(keys), values), 'nearest differs from the table'
+
+    for mode in ['interpolate', 'exact']:
+        lookup = CDF_Table(table, mode=mode)
+        scalar = np.array([lookup(z) for z in z_values])
+        assert np.allclose(scalar, lookup(z_values), rtol=0, atol=1e-12), f'{mode} (scalar) differs from {mode} (array)'
+
+        error_table = np.max(np.abs(lookup(keys) - values))
+        error_legacy = np.max(np.abs(lookup(z_values) - legacy))
+        print(f'{mode:<12} max error on table: {error_table:.2e}, max difference to closest_cdf: {error_legacy:.2e}')
+
+
+def benchmark(name, function, z_values):
+    start = time.perf_counter()
+    function(z_values)
+    duration = time.perf_counter() - start
+
+    print(f'{name:<22} {1e9 * duration / len(z_values):10.1f} ns per lookup')
+
+
+if __name__ == '__main__':
+    with open('../../src/zValue_to_pValue.json', 'r') as file:
+        table = {float(k): v for k, v in json.load(file).items()}
+
+    # Beyond the table (z > 4) closest_cdf keeps the last p-value, the exact mode does not
+    z_values = np.random.default_rng(0).uniform(0, 4, NUM_LOOKUPS)
+    check_accuracy(table, z_values)
+
+    benchmark('closest_cdf (scalar)', lambda zs: [legacy_closest_cdf(z, table) for z in zs], z_values[:10000])
+
+    for mode in ['nearest', 'interpolate', 'exact']:
+        lookup = CDF_Table(table, mode=mode)
+        benchmark(f'{mode} (scalar)', lambda zs: [lookup(z) for z in zs], z_values[:10000])
+        benchmark(f'{mode} (array)', lookup, z_values)
@@ -0,0 +1,137 @@
+'''
+Throughput of the Splunk export parsers on a synthetic export. Also checks that rows with missing
+or malformed numeric fields are dropped instead of failing the batch.
+'''
+
+import sys
+sys.path.append('../../src')
+
+import io
+import json
+import time
+
+import numpy as np
+import requests
+
+from data_api import iter_json_objects, iter_response_objects, new_column_buffers, append_result, columns_to_frame
+
+
+NUM_RECORDS = 20000
+
+
+def legacy_parse_multiple_json(text):
+    '''
+    The previous parser, walking the text one character at a time.
+    '''
+
+    json_objects = []
+    buffer = ""
+    open_brackets = 0
+
+    for char in text:
+        buffer += char
+        if char == '{':
+            open_brackets += 1
+        elif char == '}':
+            open_brackets -= 1
+            if open_brackets == 0:
+                try:
+                    json_objects.append(json.loads(buffer))
+                except json.JSONDecodeError:
+                    print("Failed to decode JSON:", buffer)
+                buffer = ""
+
+    return json_objects
+
+
+def generate_export(num_records):
+    rng = np.random.default_rng(0)
+    lines = []
+
+    for i in range(num_records):
+        result = {
+            'timestamp': str(1726000000 + i // 50),
+            'type': 'wifi',
+            'mac': f'{rng.integers(0, 2**63):064x}',
+            'map_id': '674f1f22-b555-4cb0-bdd4-df5ffe9d195f',
+            'site_id': '48b01af6-138b-465d-8996-bace824f5726',
+            'rssi': str(rng.integers(-90, -40)),
+            'x': str(rng.uniform(0, 100)),
+            'y': str(rng.uniform(0, 100)),
+        }
+        lines.append(json.dumps({'preview': False, 'offset': i, 'result': result}))
+
+    return '\n'.join(lines) + '\n'
+
+
+def benchmark(name, function, text):
+    start = time.perf_counter()
+    num_objects = function(text)
+    duration = time.perf_counter() - start
+
+    megabytes = len(text) / 1e6
+    print(f'{name:<10} {num_objects:>8} objects  {duration:8.3f} s  {megabytes / duration:8.2f} MB/s')
+
+
+def run_legacy(text):
+    return len(legacy_parse_multiple_json(text))
+
+
+def parse_columns(objects):
+    columns = new_column_buffers()
+    for entry in objects:
+        append_result(columns, entry)
+
+    return len(columns_to_frame(columns))
+
+
+def run_text(text):
+    return parse_columns(iter_json_objects([text]))
+
+
+def streamed_response(text):
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(text.encode())
+
+    return response
+
+
+def run_stream(text, **kwargs):
+    return parse_columns(iter_response_objects(streamed_response(text), **kwargs))
+
+
+def check_malformed():
+    columns = new_column_buffers()
+    rows = [
+        ('1726000000', '-50', '1.5', '2.5'), # Valid
+        ('1726000000.0', '-60', '3', '4'), # Valid, timestamp as float
+        ('', '-50', '1', '1'),
+        ('abc', '-50', '1', '1'),
+        ('1726000000', '', '1', '1'),
+        ('1726000000', 'abc', '1', '1'),
+        ('1726000000', '40000', '1', '1'), # Outside of int16
+        ('1726000000', '-50', '', '1'),
+        ('1726000000', '-50', '1', 'abc'),
+        (None, None, None, None),
+    ]
+    for i, (timestamp, rssi, x, y) in enumerate(rows):
+        result = {'timestamp': timestamp, 'type': 'wifi', 'mac': f'mac{i}', 'map_id': 'map', 'site_id': 'site', 'rssi': rssi, 'x': x, 'y': y}
+        append_result(columns, {'result': result})
+
+    data = columns_to_frame(columns)
+    assert data['mac'].tolist() == ['mac0', 'mac1'], 'Malformed rows were not dropped'
+    assert data['timestamp'].tolist() == [1726000000, 1726000000] and data['rssi'].tolist() == [-50, -60], 'Valid rows differ'
+    assert data['x'].tolist() == [1.5, 3.0] and data['y'].tolist() == [2.5, 4.0], 'Valid positions differ'
+
+
+if __name__ == '__main__':
+    check_malformed()
+
+    text = generate_export(NUM_RECORDS)
+    print(f'Export size: {len(text) / 1e6:.1f} MB')
+
+    benchmark('legacy', run_legacy, text)
+    benchmark('text', run_text, text)
+    benchmark('stream-512', lambda text: run_stream(text, chunk_size=512), text) # Default chunk size of iter_lines
+    benchmark('stream', run_stream, text)
@@ -2,7 +2,7 @@ import sys
 sys.path.append('../src')
 sys.path.append('..')
 
-from main import generate_refined_data
+from service import Refiner
 
 from tqdm import tqdm
 import pandas as pd
@@ -48,8 +48,7 @@ for i in tqdm(range(len(cutoff_indices))):
 
 
 print('Generating refined data')
-for i, batch in enumerate(tqdm(batches)):
-    if i == 0:
-        generate_refined_data(batch, first_batch=True)
-    else:
-        generate_refined_data(batch)
\ No newline at end of file
+refiner = Refiner(first_batch=True)
+for batch in tqdm(batches):
+    refiner.process_batch(batch)
+refiner.close()
\ No newline at end of file
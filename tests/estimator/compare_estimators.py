@@ -0,0 +1,169 @@
+'''
+Equality of the batched estimator.update_positions and the per-device Device.update_position
+with the previous Device.update_position, on random device histories, and the time each takes.
+'''
+
+import sys
+sys.path.append('../../src')
+
+import json
+import time
+import bisect
+
+import numpy as np
+
+from cdf_table import CDF_Table
+from device import DeviceStore, WIFI_ERROR, WINDOW, rssi_weight
+from estimator import update_positions
+
+
+NUM_DEVICES = 5000
+MAX_POINTS = 30 # Per device, more than the history size so that some ring buffers wrap around
+TOLERANCE = 1e-9
+
+
+def legacy_closest_cdf(z_value, table):
+    '''
+    The previous Device.closest_cdf.
+    '''
+
+    z_values = list(table.keys())
+    closest_index = bisect.bisect_left(z_values, z_value)
+
+    if closest_index == 0:
+        return table[z_values[0]]
+    elif closest_index == len(z_values):
+        return table[z_values[-1]]
+    else:
+        lower_value = z_values[closest_index - 1]
+        upper_value = z_values[closest_index]
+
+        if abs(z_value - lower_value) < abs(z_value - upper_value):
+            return table[lower_value]
+        else:
+            return table[upper_value]
+
+
+def legacy_update_position(positions, weights, table):
+    '''
+    The previous Device.update_position, on the positions and weights of a device, oldest first.
+    Returns the estimated x, y and error.
+    '''
+
+    positions = np.array(positions)
+    positions = positions[::-1]
+    weights = np.array(weights)
+    weights = weights[::-1]
+
+    if len(positions) == 1:
+        return positions[0][0], positions[0][1], WIFI_ERROR
+
+    prev_x = positions[0][0]
+    prev_y = positions[0][1]
+    prev_error = WIFI_ERROR
+
+    for i, position in enumerate(positions[1:]):
+
+        curr_x = position[0]
+        curr_y = position[1]
+        radius_to_prev = np.sqrt((curr_x - prev_x)**2 + (curr_y - prev_y)**2)
+
+        z = radius_to_prev / prev_error
+        probability_moved = 1 - 2 * legacy_closest_cdf(z, table)
+        probability_moved = probability_moved * weights[i]
+
+        if probability_moved > 0.8:
+            break
+
+        upper_limit = i + 2
+        x_estimate = np.sum(weights[:upper_limit] * positions[:upper_limit, 0]) / np.sum(weights[:upper_limit])
+        y_estimate = np.sum(weights[:upper_limit] * positions[:upper_limit, 1]) / np.sum(weights[:upper_limit])
+
+        if i == 0:
+            error_estimate = WIFI_ERROR
+        else:
+            error_x = np.sqrt(np.sum(weights[:upper_limit] * (positions[:upper_limit, 0] - x_estimate)**2) / np.sum(weights[:upper_limit]))
+            error_y = np.sqrt(np.sum(weights[:upper_limit] * (positions[:upper_limit, 1] - y_estimate)**2) / np.sum(weights[:upper_limit]))
+            error_estimate = np.sqrt(error_x**2 + error_y**2)
+
+        prev_x = x_estimate
+        prev_y = y_estimate
+        if np.isnan(error_estimate) or error_estimate > WIFI_ERROR:
+            prev_error = WIFI_ERROR
+        else:
+            prev_error = error_estimate
+
+        # Break to only include the most recent 10 data points
+        if i == 10:
+            break
+
+    return prev_x, prev_y, prev_error
+
+
+def generate_store():
+    rng = np.random.default_rng(0)
+    store = DeviceStore()
+
+    slots, xs, ys = [], [], []
+    for i in range(NUM_DEVICES):
+        slot = store.add_device(f'mac{i}')
+        num_points = rng.integers(1, MAX_POINTS + 1)
+
+        # Noise around one position, with a jump to another position for half of the devices
+        centers = np.tile(rng.uniform(0, 100, 2), (num_points, 1))
+        if rng.random() < 0.5:
+            centers[rng.integers(0, num_points):] = rng.uniform(0, 100, 2)
+        positions = centers + rng.normal(0, rng.uniform(0.5, 15), (num_points, 2))
+
+        slots.append(np.full(num_points, slot))
+        xs.append(positions[:, 0])
+        ys.append(positions[:, 1])
+
+    slots = np.concatenate(slots)
+    rssi_values = rng.uniform(-90, -40, len(slots))
+    store.append(slots, np.concatenate(xs), np.concatenate(ys), rssi_values, np.arange(len(slots)), np.ones(len(slots), dtype=np.int64), rssi_weight(rssi_values))
+
+    return store
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    with open('../../src/zValue_to_pValue.json', 'r') as file:
+        table = {float(k): v for k, v in json.load(file).items()}
+    zValue_to_pValue = CDF_Table(table, mode='nearest')
+
+    store = generate_store()
+    slots = np.array(list(store.slots.values()))
+
+    def run_legacy():
+        estimates = []
+        for slot in slots.tolist():
+            positions = np.column_stack([store.history(slot, 'xs'), store.history(slot, 'ys')])
+            estimates.append(legacy_update_position(positions, store.history(slot, 'weights'), table))
+        return np.array(estimates)
+
+    def run_device():
+        for device in store.devices():
+            device.update_position(zValue_to_pValue, WINDOW)
+        return store.estimates[slots].copy()
+
+    def run_batched():
+        update_positions(store, slots, zValue_to_pValue, WINDOW)
+        return store.estimates[slots].copy()
+
+    legacy, time_legacy = timed(run_legacy)
+    device, time_device = timed(run_device)
+    batched, time_batched = timed(run_batched)
+
+    for name, estimates in [('Device.update_position', device), ('update_positions', batched)]:
+        for column, field in enumerate(['x', 'y', 'error']):
+            difference = np.max(np.abs(estimates[:, column] - legacy[:, column]))
+            assert difference <= TOLERANCE, f'{field} of {name} differs by {difference:.2e}'
+
+    print(f'{NUM_DEVICES} devices, positions and errors equal within {TOLERANCE}')
+    print(f'previous update_position: {time_legacy:.3f} s, Device.update_position: {time_device:.3f} s, update_positions: {time_batched:.3f} s')
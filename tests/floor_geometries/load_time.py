@@ -0,0 +1,103 @@
+'''
+Load time of the per-floor geometry store against the pickles of all room geometries and floor
+trees it replaces, on a synthetic estate. Also checks that the stored polygons and the room
+assignment of random points equal the ones of the pickles.
+'''
+
+import sys
+sys.path.append('../../src')
+
+import os
+import time
+import pickle
+import tempfile
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
+
+from floor_geometries import Floor_Geometries, floor_hash, write_floor, write_index, load_floor
+
+
+NUM_FLOORS = 400
+NUM_ROOMS = 150 # Per floor
+NUM_VERTICES = 12 # Per room
+NUM_POINTS = 10000 # Per checked floor
+
+
+def generate_floors() -> dict:
+    rng = np.random.default_rng(0)
+    angles = np.linspace(0, 2*np.pi, NUM_VERTICES, endpoint=False)
+
+    floors = {}
+    for floor_id in range(1, NUM_FLOORS + 1):
+        room_geometries = {}
+        for i in range(NUM_ROOMS):
+            center = (i % 15 * 10 + 5, i // 15 * 10 + 5)
+            radius = 4 + rng.uniform(-0.5, 0.5, NUM_VERTICES)
+            room_geometries[floor_id * 1000 + i] = Polygon(np.column_stack([center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)]))
+        floors[floor_id] = room_geometries
+
+    return floors
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def load_pickle(path: str):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+if __name__ == '__main__':
+    floors = generate_floors()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The pickles written by init.py before the store
+        path_geometries = os.path.join(directory, 'room_geometries.pkl')
+        path_trees = os.path.join(directory, 'floor_trees.pkl')
+        with open(path_geometries, 'wb') as file:
+            pickle.dump({room_id: polygon for room_geometries in floors.values() for room_id, polygon in room_geometries.items()}, file)
+        with open(path_trees, 'wb') as file:
+            pickle.dump({floor_id: STRtree(list(room_geometries.values())) for floor_id, room_geometries in floors.items()}, file)
+
+        path_store = os.path.join(directory, 'floors')
+        os.makedirs(path_store)
+        index = {}
+        for floor_id, room_geometries in floors.items():
+            hash = floor_hash([[room_id, list(polygon.exterior.coords)] for room_id, polygon in room_geometries.items()], [0, 0])
+            index[str(floor_id)] = {'hash': hash, 'name': write_floor(floor_id, hash, room_geometries, path_store)}
+        write_index(index, path_store)
+
+        floor_trees, time_trees = timed(load_pickle, path_trees)
+        room_geometries, time_geometries = timed(load_pickle, path_geometries)
+
+        store, time_store = timed(Floor_Geometries, path_store)
+        tree, time_first = timed(store.__getitem__, 1)
+        tree, time_cached = timed(store.__getitem__, 1)
+        (room_ids, rooms), time_floor = timed(load_floor, 1, path_store)
+
+        # Stored polygons and room IDs equal the pickled ones
+        rng = np.random.default_rng(1)
+        for floor_id in rng.choice(NUM_FLOORS, 20, replace=False) + 1:
+            room_ids, polygons = load_floor(floor_id, path_store)
+            assert room_ids.tolist() == list(floors[floor_id].keys()), f'Room IDs of floor {floor_id} differ'
+            assert shapely.equals_exact(np.array(polygons), np.array(list(floors[floor_id].values())), 0).all(), f'Polygons of floor {floor_id} differ'
+
+            points = shapely.points(rng.uniform(0, 150, (NUM_POINTS, 2)))
+            expected = floor_trees[floor_id].query(points, predicate='within')
+            result = store[floor_id].query(points, predicate='within')
+            assert np.array_equal(expected, result), f'Room assignment of floor {floor_id} differs'
+
+        size_pickles = os.path.getsize(path_trees) + os.path.getsize(path_geometries)
+        size_store = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path_store) for name in names)
+
+    print(f'{NUM_FLOORS} floors of {NUM_ROOMS} rooms, polygons, room IDs and room assignment equal')
+    print(f'refiner start, floor_trees.pkl: {time_trees:.3f} s, Floor_Geometries: {time_store:.3f} s')
+    print(f'first use of a floor tree: {time_first*1000:.2f} ms, cached: {time_cached*1000:.3f} ms')
+    print(f'rooms of a floor for the API, room_geometries.pkl: {time_geometries:.3f} s, load_floor: {time_floor*1000:.2f} ms')
+    print(f'size, pickles: {size_pickles/1e6:.1f} MB, store: {size_store/1e6:.1f} MB')
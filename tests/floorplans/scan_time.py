@@ -0,0 +1,93 @@
+'''
+Time of init.scan_floorplans, cold, warm and after one modified file, against parsing the state.yaml
+files like init.py did before, i.e. the building state once per floor with the pure-Python loader.
+The map IDs and offsets of both are checked to be equal, on synthetic floorplans.
+'''
+
+import sys
+sys.path.append('../../src')
+
+import os
+import time
+import tempfile
+
+import yaml
+
+from init import scan_floorplans
+
+
+NUM_BUILDINGS = 100
+NUM_FLOORS = 10 # Per building
+NUM_ITEMS = 50 # Entries of the layout in a state.yaml, to give the files a realistic size
+
+
+def write_floorplans(path: str) -> dict:
+    building_ids = {}
+
+    for building_id in range(1, NUM_BUILDINGS + 1):
+        os.makedirs(f'{path}/buildings_by_id/{building_id}')
+        layout = None if building_id % 25 == 0 else {
+            'viewbox': f'{-building_id * 1.5} {building_id * 2.25} 500 400',
+            'items': [{'id': i, 'name': f'Item {i}', 'points': [[i, i + 1], [i + 2, i + 3]]} for i in range(NUM_ITEMS)],
+        }
+        with open(f'{path}/buildings_by_id/{building_id}/state.yaml', 'w') as file:
+            yaml.safe_dump({'id': building_id, 'layout': layout}, file)
+
+        for i in range(NUM_FLOORS):
+            floor_id = building_id * 100 + i
+            building_ids[floor_id] = building_id
+
+            os.makedirs(f'{path}/floors_by_id/{floor_id}')
+            state = {'id': floor_id, 'mist_mapid': f'map-{floor_id}', 'items': [{'id': j, 'name': f'Item {j}'} for j in range(NUM_ITEMS)]}
+            with open(f'{path}/floors_by_id/{floor_id}/state.yaml', 'w') as file:
+                yaml.safe_dump(state, file)
+
+    return building_ids
+
+
+def legacy_scan(path: str, building_ids: dict) -> tuple:
+    offsets = {}
+    floorId_to_mapId = {}
+
+    for floor_id in os.listdir(f'{path}/floors_by_id'):
+        floor_id = int(floor_id)
+
+        with open(f'{path}/buildings_by_id/{building_ids[floor_id]}/state.yaml') as file:
+            data = yaml.safe_load(file)
+        offsets[floor_id] = None if data['layout'] is None else [-float(num) for num in data['layout']['viewbox'].split()[:2]]
+
+        with open(f'{path}/floors_by_id/{floor_id}/state.yaml') as file:
+            floorId_to_mapId[floor_id] = yaml.safe_load(file)['mist_mapid']
+
+    return offsets, floorId_to_mapId
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'floorplans-main')
+        path_index = os.path.join(directory, 'floorplans_index.json')
+        building_ids = write_floorplans(path)
+
+        (offsets, floorId_to_mapId), time_legacy = timed(legacy_scan, path, building_ids)
+        floorplans, time_cold = timed(scan_floorplans, path, path_index)
+        warm, time_warm = timed(scan_floorplans, path, path_index)
+
+        for floor_id, building_id in building_ids.items():
+            assert floorplans['floors'][str(floor_id)]['mapId'] == floorId_to_mapId[floor_id], f'Map ID of floor {floor_id} differs'
+            assert floorplans['buildings'][str(building_id)]['offset'] == offsets[floor_id], f'Offset of floor {floor_id} differs'
+        assert warm == floorplans, 'Warm scan differs'
+
+        # A modified building is parsed again
+        with open(f'{path}/buildings_by_id/1/state.yaml', 'w') as file:
+            yaml.safe_dump({'id': 1, 'layout': {'viewbox': '10 20 500 400'}}, file)
+        modified, time_modified = timed(scan_floorplans, path, path_index)
+        assert modified['buildings']['1']['offset'] == [-10.0, -20.0], 'Modified building was not parsed again'
+
+    print(f'{NUM_BUILDINGS * NUM_FLOORS} floors of {NUM_BUILDINGS} buildings, map IDs and offsets equal')
+    print(f'legacy: {time_legacy:.3f} s, cold scan: {time_cold:.3f} s, warm: {time_warm:.3f} s, one building modified: {time_modified:.3f} s')
@@ -0,0 +1,204 @@
+'''
+Equality of occupancy.aggregate_occupancy with the per-room loop it replaced, populate_data, on
+synthetic refined data and Pythagoras floor data, and the time both take.
+'''
+
+import sys
+sys.path.append('../../src')
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from occupancy import init_data, aggregate_occupancy, build_room_dimension, convert_timestamp_to_dateTime, add_owner_data, add_no_owner_data
+
+
+NUM_FLOORS = 5
+NUM_ROOMS = 200 # Per floor
+NUM_TIMESTAMPS = 24
+NUM_DEVICES = 2000 # Per timestamp
+
+
+def generate_floor_data():
+    floor_infos = {}
+    floor_workspaces = {}
+
+    for floor_id in range(1, NUM_FLOORS + 1):
+        floor_infos[floor_id] = {
+            'uid': f'F{floor_id}',
+            'name': f'Floor {floor_id}',
+            'popularName': f'Floor {floor_id} popular',
+            'buildingId': 10 + floor_id % 2,
+            'buildingUid': f'B{10 + floor_id % 2}',
+            'buildingName': f'Building {10 + floor_id % 2}',
+            'buildingPopularName': f'Building {10 + floor_id % 2} popular',
+        }
+
+        floor_workspaces[floor_id] = []
+        for i in range(NUM_ROOMS):
+            room_id = floor_id * 10000 + i
+            room = {
+                'id': room_id,
+                'uid': f'R{room_id}',
+                'name': f'Room {room_id}',
+                'popularName': f'Room {room_id} popular',
+                'grossarea': 10.0 + i,
+                'netarea': 8.0 + i,
+                'typeId': i % 7,
+                'typeName': f'Type {i % 7}',
+            }
+
+            # Rooms without owner, with and without the key
+            if i % 5 == 0:
+                room['ownerId'] = None
+            elif i % 5 != 1:
+                room['ownerId'] = 100 + i % 3
+                room['ownerCode'] = f'SD{100 + i % 3}'
+                room['ownerName'] = f'Sub-department {100 + i % 3}'
+
+            floor_workspaces[floor_id].append(room)
+
+    department_mappings = {'1': {'code': 'FAC', 'name': 'Faculty', 'treeLevel': 0, 'path': '/1'}}
+    for i in range(3):
+        department_mappings[str(20 + i)] = {'code': f'D{20 + i}', 'name': f'Department {20 + i}', 'treeLevel': 1, 'path': f'/1/{20 + i}'}
+        department_mappings[str(100 + i)] = {'code': f'SD{100 + i}', 'name': f'Sub-department {100 + i}', 'treeLevel': 2, 'path': f'/1/{20 + i}/{100 + i}'}
+
+    return floor_infos, floor_workspaces, department_mappings
+
+
+def generate_refined_data():
+    rng = np.random.default_rng(0)
+
+    floor_ids = rng.integers(1, NUM_FLOORS + 1, NUM_TIMESTAMPS * NUM_DEVICES)
+    room_ids = floor_ids * 10000 + rng.integers(0, NUM_ROOMS, len(floor_ids))
+    room_ids = pd.array(room_ids, dtype='Int64')
+    room_ids[rng.random(len(floor_ids)) < 0.2] = pd.NA # Positions outside of rooms
+
+    return pd.DataFrame({
+        'timestamp': np.repeat(1726000000 + 300 * np.arange(NUM_TIMESTAMPS), NUM_DEVICES),
+        'floor_id': floor_ids,
+        'room_id': room_ids,
+    })
+
+
+def room_valid(batch: pd.DataFrame, room_id: int) -> bool:
+    '''
+    Check if the room is valid.
+    
+    Args:
+        batch (pd.DataFrame): Batch.
+        room_id (int): Room ID, missing (NA) if the positions are not in a room.
+        
+    Returns:
+        bool: True if the room is valid, False otherwise.
+    '''
+
+    if pd.isna(room_id):
+        return False
+
+    #room_id = int(room_id)
+
+    room = batch[batch['room_id'] == room_id]
+    if len(room) == 0:
+        return False
+
+    return True
+
+
+def populate_data(data: dict, batches: list, floor_infos: dict, floor_workspaces: dict, department_mappings: dict) -> list:
+    '''
+    Populates the data dictionary, one room of one batch at a time, like occupancy.py did before
+    aggregate_occupancy.
+
+    Args:
+        data (dict): Dictionary.
+        batches (list): List of batches.
+        floor_infos (dict): Floor infos.
+        floor_workspaces (dict): Floor workspaces.
+        department_mappings (dict): Department mappings.
+
+    Returns:
+        list: Data.
+    '''
+
+    for batch in batches:
+        room_ids = batch['room_id'].unique()
+
+        for room_id in room_ids:
+            if room_valid(batch, room_id) == False: continue
+
+            room = batch[batch['room_id'] == room_id]
+            floor_id = room['floor_id'].to_list()[0]
+
+            floor_info = floor_infos[floor_id]
+            floor_workspace = floor_workspaces[floor_id]
+            floor_workspace = {item['id']: item for item in floor_workspace}
+
+            data['timestamp'].append(room['timestamp'].to_list()[0])
+            data['date_time'].append(convert_timestamp_to_dateTime(room['timestamp'].to_list()[0]))
+            data['num_devices'].append(len(room))
+
+            room_id = int(room_id)
+
+            # room info
+            data['room_id'].append(room_id)
+            data['room_uid'].append(floor_workspace[room_id]['uid'])
+            data['room_name'].append(floor_workspace[room_id]['name'])
+            data['room_popular_name'].append(floor_workspace[room_id]['popularName'])
+            data['room_gross_area'].append(floor_workspace[room_id]['grossarea'])
+            data['room_net_area'].append(floor_workspace[room_id]['netarea'])
+            data['room_type_id'].append(floor_workspace[room_id]['typeId'])
+            data['room_type_name'].append(floor_workspace[room_id]['typeName'])
+
+            # floor info
+            data['floor_id'].append(floor_id)
+            data['floor_uid'].append(floor_info['uid'])
+            data['floor_name'].append(floor_info['name'])
+            data['floor_popular_name'].append(floor_info['popularName'])
+
+            # celcat info
+            floor_name = floor_info['name']
+            room_name = floor_workspace[room_id]['name']
+            data['celcat_name'].append(f'{floor_name}-{room_name}')
+
+            # building info
+            data['building_id'].append(floor_info['buildingId'])
+            data['building_uid'].append(floor_info['buildingUid'])
+            data['building_name'].append(floor_info['buildingName'])
+            data['building_popular_name'].append(floor_info['buildingPopularName'])
+
+            # room owner info
+            if 'ownerId' not in floor_workspace[room_id] or floor_workspace[room_id]['ownerId'] is None:
+                data = add_no_owner_data(data)
+            else:
+                data = add_owner_data(data, floor_workspace, department_mappings, room_id)
+
+
+    return data
+
+
+if __name__ == '__main__':
+    floor_infos, floor_workspaces, department_mappings = generate_floor_data()
+    dataframe = generate_refined_data()
+
+    start = time.perf_counter()
+    batches = [batch for timestamp, batch in dataframe.groupby('timestamp', sort=True)]
+    legacy = populate_data(init_data(), batches, floor_infos, floor_workspaces, department_mappings)
+    time_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    room_dimension = build_room_dimension(floor_infos, floor_workspaces, department_mappings)
+    vectorized = aggregate_occupancy(dataframe, room_dimension)
+    time_vectorized = time.perf_counter() - start
+
+    # The loop keeps the order of appearance of the rooms, aggregate_occupancy sorts them
+    legacy = pd.DataFrame(legacy, dtype=object).sort_values(['timestamp', 'room_id']).reset_index(drop=True)
+    vectorized = pd.DataFrame(vectorized, dtype=object)
+
+    assert list(legacy.columns) == list(vectorized.columns), 'Columns differ'
+    for column in legacy.columns:
+        assert legacy[column].tolist() == vectorized[column].tolist(), f'Column {column} differs'
+
+    print(f'{len(vectorized)} rows equal')
+    print(f'populate_data: {time_legacy:.3f} s, aggregate_occupancy: {time_vectorized:.3f} s')
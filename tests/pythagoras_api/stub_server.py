@@ -0,0 +1,195 @@
+'''
+Pythagoras_API against a local stub of the Pythagoras API. The stub answers with synthetic floors,
+fails the first request of some paths to exercise the retries, and delays every response, so
+fetch_floors can be timed against fetching the floors one after another. The stub sends ETags,
+so the response cache is checked cold, warm, revalidated and offline.
+'''
+
+import sys
+sys.path.append('../../src')
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+import pythagoras_api
+from pythagoras_api import Pythagoras_API, get_roomIds_from_workspace
+from response_cache import Response_Cache
+
+
+NUM_FLOORS = 40
+NUM_ROOMS = 20 # Per floor
+DELAY = 0.05 # Seconds per response
+API_KEY = 'stub-key'
+
+
+def generate_responses() -> dict:
+    responses = {'/imp_datamanager/rest/v1/floor': [{'id': floor_id} for floor_id in range(1, NUM_FLOORS + 1)]}
+
+    for floor_id in range(1, NUM_FLOORS + 1):
+        rooms = []
+        for i in range(NUM_ROOMS):
+            room_id = floor_id * 1000 + i
+            rooms.append({'id': room_id, 'name': f'Room {room_id}', 'outline': {'coords': [{'x': i, 'y': 0}, {'x': i + 1, 'y': 0}, {'x': i + 1, 'y': 1}]}})
+
+        responses[f'/imp_datamanager/rest/v1/floor/{floor_id}/info'] = {'id': floor_id, 'buildingId': 10 + floor_id % 3}
+        responses[f'/imp_datamanager/rest/v1/floor/{floor_id}/workspace/info'] = rooms
+        responses[f'/imp_datamanager/rest/v1/floor/{floor_id}/workspace'] = [{'id': room['id']} for room in rooms]
+
+    return responses
+
+
+class Stub_Handler(BaseHTTPRequestHandler):
+    responses = generate_responses()
+    requests = {} # Number of requests by path
+    not_modified = 0 # Number of 304 responses
+    lock = threading.Lock()
+
+    def do_GET(self) -> None:
+        path = urlparse(self.path).path
+
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            count = self.requests[path]
+
+        time.sleep(DELAY)
+
+        if self.headers.get('api_key') != API_KEY:
+            return self.reply(401, {'error': 'unauthorized'})
+        if path not in self.responses:
+            return self.reply(404, {'error': 'not found'})
+
+        # Every third floor info is rate limited once, every fifth workspace fails once
+        floor_id = int(path.split('/')[5]) if path.count('/') > 4 else 0
+        if count == 1 and path.endswith('/info') and not path.endswith('workspace/info') and floor_id % 3 == 0:
+            return self.reply(429, {'error': 'rate limited'}, {'Retry-After': '0'})
+        if count == 1 and path.endswith('workspace/info') and floor_id % 5 == 0:
+            return self.reply(503, {'error': 'unavailable'})
+
+        etag = '"' + hashlib.sha1(json.dumps(self.responses[path]).encode()).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            with self.lock:
+                Stub_Handler.not_modified += 1
+            return self.reply(304, None, {'ETag': etag})
+
+        self.reply(200, self.responses[path], {'ETag': etag})
+
+    def reply(self, status: int, body, headers: dict = {}) -> None:
+        content = json.dumps(body).encode() if body is not None else b''
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if status != 304:
+            self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+if __name__ == '__main__':
+    pythagoras_api.BACKOFF_BASE = 0.01
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Stub_Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/imp_datamanager'
+
+    api = Pythagoras_API(base_url=base_url, api_key=API_KEY, cache_path=None)
+    floor_ids = api.get_floor_ids()
+    assert floor_ids == list(range(1, NUM_FLOORS + 1)), 'Floor IDs differ'
+
+    start = time.perf_counter()
+    floor_infos, floor_workspaces = api.fetch_floors(floor_ids)
+    time_concurrent = time.perf_counter() - start
+
+    assert list(floor_infos) == floor_ids and list(floor_workspaces) == floor_ids, 'Floors are not in order'
+    for floor_id in floor_ids:
+        assert floor_infos[floor_id] == Stub_Handler.responses[f'/imp_datamanager/rest/v1/floor/{floor_id}/info'], f'Info of floor {floor_id} differs'
+        assert floor_workspaces[floor_id] == Stub_Handler.responses[f'/imp_datamanager/rest/v1/floor/{floor_id}/workspace/info'], f'Workspace of floor {floor_id} differs'
+
+    retried = sum(1 for count in Stub_Handler.requests.values() if count == 2)
+    assert retried == NUM_FLOORS // 3 + NUM_FLOORS // 5, 'Failed requests were not retried once'
+
+    # Room IDs from the fetched workspaces equal the ones of the workspace endpoint
+    for floor_id in floor_ids:
+        assert get_roomIds_from_workspace(floor_workspaces[floor_id]) == api.get_floor_roomIds(floor_id), f'Room IDs of floor {floor_id} differ'
+
+    # Client errors are raised without retries
+    try:
+        api.get('/rest/v1/floor/0/info')
+        raise AssertionError('Missing floor did not raise')
+    except requests.HTTPError as error:
+        assert error.response.status_code == 404
+    assert Stub_Handler.requests['/imp_datamanager/rest/v1/floor/0/info'] == 1, 'Client error was retried'
+
+    sequential_api = Pythagoras_API(base_url=base_url, api_key=API_KEY, max_workers=1, cache_path=None)
+    start = time.perf_counter()
+    sequential_api.fetch_floors(floor_ids)
+    time_sequential = time.perf_counter() - start
+
+    api.close()
+    sequential_api.close()
+
+    print(f'{NUM_FLOORS} floors equal, {retried} requests retried')
+    print(f'sequential: {time_sequential:.3f} s, fetch_floors: {time_concurrent:.3f} s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, 'cache.db')
+
+        def fetch(**kwargs) -> tuple:
+            cached_api = Pythagoras_API(base_url=base_url, api_key=API_KEY, cache_path=cache_path, **kwargs)
+            num_requests = sum(Stub_Handler.requests.values())
+
+            start = time.perf_counter()
+            result = cached_api.fetch_floors(floor_ids)
+            elapsed = time.perf_counter() - start
+
+            cached_api.close()
+            assert result == (floor_infos, floor_workspaces), 'Cached floors differ'
+            return sum(Stub_Handler.requests.values()) - num_requests, elapsed
+
+        num_cold, time_cold = fetch()
+        assert num_cold == 2*NUM_FLOORS, 'Cold cache did not fetch every floor once'
+
+        num_warm, time_warm = fetch()
+        assert num_warm == 0, 'Warm cache made requests'
+
+        not_modified = Stub_Handler.not_modified
+        num_expired, time_expired = fetch(ttl=0)
+        assert num_expired == 2*NUM_FLOORS and Stub_Handler.not_modified - not_modified == 2*NUM_FLOORS, 'Expired responses were not revalidated'
+
+        server.shutdown()
+        server.server_close()
+
+        num_offline, time_offline = fetch(ttl=0, offline=True)
+        assert num_offline == 0, 'Offline mode made requests'
+
+        offline_api = Pythagoras_API(base_url=base_url, cache_path=cache_path, offline=True)
+        try:
+            offline_api.get_organisations()
+            raise AssertionError('Uncached response did not raise offline')
+        except requests.ConnectionError:
+            pass
+        offline_api.close()
+
+        # The least recently used responses are evicted above the size bound
+        cache = Response_Cache(os.path.join(directory, 'small.db'), max_bytes=4000)
+        for i in range(3):
+            cache.put(f'key{i}', os.urandom(1000))
+        cache.get('key0')
+        cache.put('key3', os.urandom(1000))
+        keys = sorted(key for key, in cache.conn.execute('SELECT key FROM responses'))
+        assert keys == ['key0', 'key2', 'key3'], 'Eviction is not least recently used'
+        cache.close()
+
+    print(f'cold cache: {time_cold:.3f} s, warm: {time_warm:.3f} s, revalidated: {time_expired:.3f} s, offline: {time_offline:.3f} s')